@@ -0,0 +1,101 @@
+import os
+import re
+from decimal import Decimal
+
+from dotenv import load_dotenv
+load_dotenv()
+
+# 'template' renders the common result shapes here and only asks the LLM
+# for the rest; 'llm' always sends the rows to treat_query_system.
+QUERY_ANSWER_MODE = os.getenv('QUERY_ANSWER_MODE', 'template').lower()
+
+_NAME_COLUMNS = {'name', 'item', 'item_name', 'nome', 'produto'}
+_UNIT_COLUMNS = {'unit', 'unidade'}
+_CATEGORY_COLUMNS = {'category', 'categoria'}
+_LOCATION_COLUMNS = {'location', 'local', 'localizacao'}
+_QUANTITY_RE = re.compile(r'^(?:(?:sum|total|soma)_?)?(?:quantity|quantidade|qtd)(?:_?(?:total|sum|soma))?$'
+                          r'|^(?:sum|total|soma|count|contagem|n_items|num_items|total_items)$')
+
+_UNIT_NAMES = {
+    'un': ('unidade', 'unidades'),
+    'duz': ('dúzia', 'dúzias'),
+    'cx': ('caixa', 'caixas'),
+    'saco': ('saco', 'sacos'),
+    'rol': ('rolo', 'rolos'),
+    'pcs': ('pedaço', 'pedaços'),
+}
+
+
+def _role(column: str) -> str | None:
+    column = column.lower()
+    if column in _NAME_COLUMNS:
+        return 'name'
+    if column in _UNIT_COLUMNS:
+        return 'unit'
+    if column in _CATEGORY_COLUMNS:
+        return 'category'
+    if column in _LOCATION_COLUMNS:
+        return 'location'
+    if _QUANTITY_RE.match(column):
+        return 'quantity'
+    return None
+
+
+def format_quantity(quantity, unit: str | None = None) -> str:
+    if quantity is None:
+        return 'quantidade desconhecida'
+    quantity = Decimal(str(quantity))
+    number = f'{quantity:.0f}' if quantity == quantity.to_integral_value() else f'{quantity:.2f}'.replace('.', ',')
+    if not unit:
+        return number
+    singular, plural = _UNIT_NAMES.get(unit, (unit, unit))
+    return f'{number} {singular if quantity == 1 else plural}'
+
+
+def _describe(row: dict) -> str:
+    text = row['name']
+    if 'quantity' in row:
+        text += f": {format_quantity(row['quantity'], row.get('unit'))}"
+    details = [row[key] for key in ('category', 'location') if row.get(key)]
+    if details:
+        text += f" ({', '.join(map(str, details))})"
+    return text
+
+
+def render_query_answer(columns: list[str], rows: list[tuple], truncated: bool = False) -> str | None:
+    """Render the common result shapes in Portuguese, or return None for the LLM to handle.
+
+    Handles an empty result, a single item, a list of items and totals per
+    category. Every column has to be recognized, otherwise the shape is
+    unknown and nothing is rendered.
+    """
+    if not rows:
+        return 'Nenhum item encontrado no seu estoque.'
+    roles = [_role(column) for column in columns]
+    if None in roles or len(set(roles)) != len(roles):
+        return None
+    records = [dict(zip(roles, row)) for row in rows]
+
+    if 'name' in roles:
+        if len(records) == 1 and 'quantity' in roles:
+            record = records[0]
+            answer = f"Há {format_quantity(record['quantity'], record.get('unit'))} de {record['name']}."
+            extra = [f"categoria {record['category']}" if record.get('category') else None,
+                     f"em {record['location']}" if record.get('location') else None]
+            extra = [e for e in extra if e]
+            if extra:
+                answer = answer[:-1] + f" ({', '.join(extra)})."
+        else:
+            lines = '\n'.join(f'- {_describe(record)}' for record in records)
+            answer = f'Itens no seu estoque:\n{lines}'
+    elif roles[0] == 'category' and 'quantity' in roles and set(roles) <= {'category', 'quantity', 'unit'}:
+        lines = '\n'.join(
+            f"- {record['category'] or 'sem categoria'}: {format_quantity(record['quantity'], record.get('unit'))}"
+            for record in records)
+        answer = f'Totais por categoria:\n{lines}'
+    else:
+        return None
+
+    if truncated:
+        answer += f'\n(Mostrando apenas os primeiros {len(rows)} resultados.)'
+    return answer
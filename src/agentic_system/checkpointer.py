@@ -0,0 +1,336 @@
+import asyncio
+import os
+import time
+import zlib
+from collections import OrderedDict, defaultdict
+from collections.abc import AsyncIterator, Sequence
+from datetime import datetime, timedelta
+from typing import Any
+
+from langchain_core.runnables import RunnableConfig
+from langgraph.checkpoint.base import (WRITES_IDX_MAP, BaseCheckpointSaver, ChannelVersions,
+                                       Checkpoint, CheckpointMetadata, CheckpointTuple,
+                                       SerializerProtocol, get_checkpoint_id,
+                                       get_checkpoint_metadata)
+from langgraph.checkpoint.memory import InMemorySaver
+from langgraph.checkpoint.serde.jsonplus import JsonPlusSerializer
+from sqlalchemy import and_, delete, exists, func, select
+from sqlalchemy.dialects.postgresql import insert
+
+from src.database.engine import dispose_engine, get_sessionmaker
+from src.database.models import GraphCheckpoint, GraphCheckpointWrite
+from dotenv import load_dotenv
+load_dotenv()
+
+CHECKPOINT_BACKEND = os.getenv('CHECKPOINT_BACKEND', 'memory').lower()
+CHECKPOINT_TTL = float(os.getenv('CHECKPOINT_TTL', str(24 * 3600)))
+CHECKPOINT_MAX_THREADS = int(os.getenv('CHECKPOINT_MAX_THREADS', '10000'))
+CHECKPOINT_KEEP_LAST = int(os.getenv('CHECKPOINT_KEEP_LAST', '2'))
+CHECKPOINT_COMPRESS_MIN_BYTES = int(os.getenv('CHECKPOINT_COMPRESS_MIN_BYTES', '512'))
+
+# Types from our own state that the serializer may rebuild from a checkpoint.
+# User ids read through asyncpg are its uuid.UUID subclass.
+STATE_TYPES = [
+    ('src.agentic_system.basemodels', name)
+    for name in ('ActionOptions', 'UnitOptions', 'UpdateBaseModel', 'TaskOptions', 'TaskModel',
+                 'ListTaskModel', 'SQLQueryBaseModel')
+] + [('asyncpg.pgproto.pgproto', 'UUID')]
+
+
+class CompactSerializer(SerializerProtocol):
+    """msgpack (JsonPlusSerializer) with zlib on top for payloads above `min_bytes`."""
+
+    SUFFIX = '+zlib'
+
+    def __init__(self, serde: SerializerProtocol | None = None,
+                 min_bytes: int = CHECKPOINT_COMPRESS_MIN_BYTES, level: int = 6):
+        self.serde = serde or JsonPlusSerializer(allowed_msgpack_modules=STATE_TYPES)
+        self.min_bytes = min_bytes
+        self.level = level
+
+    def dumps_typed(self, obj: Any) -> tuple[str, bytes]:
+        type_, data = self.serde.dumps_typed(obj)
+        if len(data) >= self.min_bytes:
+            compressed = zlib.compress(data, self.level)
+            if len(compressed) < len(data):
+                return type_ + self.SUFFIX, compressed
+        return type_, data
+
+    def loads_typed(self, data: tuple[str, bytes]) -> Any:
+        type_, payload = data
+        if type_.endswith(self.SUFFIX):
+            type_, payload = type_[:-len(self.SUFFIX)], zlib.decompress(payload)
+        return self.serde.loads_typed((type_, payload))
+
+
+class BoundedMemorySaver(InMemorySaver):
+    """InMemorySaver that forgets idle conversations and old checkpoints.
+
+    - only the latest `keep_last` checkpoints of each thread are kept, with
+      the channel values and pending writes they reference;
+    - a thread idle for `ttl` seconds is dropped;
+    - past `max_threads`, the least recently used thread is dropped.
+    """
+
+    def __init__(self, *, ttl: float = CHECKPOINT_TTL, max_threads: int = CHECKPOINT_MAX_THREADS,
+                 keep_last: int = CHECKPOINT_KEEP_LAST, serde: SerializerProtocol | None = None):
+        super().__init__(serde=serde or CompactSerializer())
+        self.ttl = ttl
+        self.max_threads = max_threads
+        self.keep_last = max(keep_last, 1)
+        self._last_used: OrderedDict[str, float] = OrderedDict()
+        # Per thread: channel versions of each stored checkpoint, and the
+        # keys of its blobs and writes, so pruning never scans other threads.
+        self._versions: dict[str, dict[tuple[str, str], ChannelVersions]] = defaultdict(dict)
+        self._blob_keys: dict[str, set] = defaultdict(set)
+        self._write_keys: dict[str, set] = defaultdict(set)
+
+    def _touch(self, thread_id: str):
+        self._last_used[thread_id] = time.monotonic()
+        self._last_used.move_to_end(thread_id)
+
+    def _expired(self, thread_id: str) -> bool:
+        last_used = self._last_used.get(thread_id)
+        return last_used is not None and time.monotonic() - last_used > self.ttl
+
+    def _evict(self):
+        while self._last_used:
+            thread_id, last_used = next(iter(self._last_used.items()))
+            if len(self._last_used) <= self.max_threads and time.monotonic() - last_used <= self.ttl:
+                break
+            self.delete_thread(thread_id)
+
+    def _prune(self, thread_id: str, checkpoint_ns: str):
+        checkpoints = self.storage[thread_id][checkpoint_ns]
+        if len(checkpoints) <= self.keep_last:
+            return
+        versions = self._versions[thread_id]
+        for checkpoint_id in sorted(checkpoints)[:-self.keep_last]:
+            del checkpoints[checkpoint_id]
+            versions.pop((checkpoint_ns, checkpoint_id), None)
+            write_key = (thread_id, checkpoint_ns, checkpoint_id)
+            self.writes.pop(write_key, None)
+            self._write_keys[thread_id].discard(write_key)
+        referenced = {(thread_id, ns, channel, version)
+                      for (ns, _), channel_versions in versions.items()
+                      for channel, version in channel_versions.items()}
+        blob_keys = self._blob_keys[thread_id]
+        for key in [k for k in blob_keys if k[1] == checkpoint_ns and k not in referenced]:
+            self.blobs.pop(key, None)
+            blob_keys.discard(key)
+
+    def get_tuple(self, config: RunnableConfig) -> CheckpointTuple | None:
+        thread_id = config['configurable']['thread_id']
+        if self._expired(thread_id):
+            self.delete_thread(thread_id)
+            return None
+        if thread_id not in self.storage:
+            return None
+        self._touch(thread_id)
+        return super().get_tuple(config)
+
+    def put(self, config: RunnableConfig, checkpoint: Checkpoint,
+            metadata: CheckpointMetadata, new_versions: ChannelVersions) -> RunnableConfig:
+        thread_id = config['configurable']['thread_id']
+        checkpoint_ns = config['configurable']['checkpoint_ns']
+        next_config = super().put(config, checkpoint, metadata, new_versions)
+        self._versions[thread_id][(checkpoint_ns, checkpoint['id'])] = dict(checkpoint['channel_versions'])
+        self._blob_keys[thread_id].update((thread_id, checkpoint_ns, k, v) for k, v in new_versions.items())
+        self._prune(thread_id, checkpoint_ns)
+        self._touch(thread_id)
+        self._evict()
+        return next_config
+
+    def put_writes(self, config: RunnableConfig, writes: Sequence[tuple[str, Any]],
+                   task_id: str, task_path: str = '') -> None:
+        super().put_writes(config, writes, task_id, task_path)
+        thread_id = config['configurable']['thread_id']
+        self._write_keys[thread_id].add(
+            (thread_id, config['configurable'].get('checkpoint_ns', ''),
+             config['configurable']['checkpoint_id']))
+
+    def delete_thread(self, thread_id: str) -> None:
+        self.storage.pop(thread_id, None)
+        for key in self._write_keys.pop(thread_id, ()):
+            self.writes.pop(key, None)
+        for key in self._blob_keys.pop(thread_id, ()):
+            self.blobs.pop(key, None)
+        self._versions.pop(thread_id, None)
+        self._last_used.pop(thread_id, None)
+
+
+class PostgresSaver(BaseCheckpointSaver[int]):
+    """Durable checkpointer on the application's database.
+
+    Each checkpoint is stored whole (channel values included) and only the
+    latest `keep_last` per thread survive a put, so a conversation costs a
+    few rows regardless of its length. prune() removes idle threads.
+    """
+
+    def __init__(self, *, keep_last: int = CHECKPOINT_KEEP_LAST, serde: SerializerProtocol | None = None):
+        super().__init__(serde=serde or CompactSerializer())
+        self.keep_last = max(keep_last, 1)
+
+    @staticmethod
+    def _scope(model, thread_id: str, checkpoint_ns: str):
+        return and_(model.thread_id == thread_id, model.checkpoint_ns == checkpoint_ns)
+
+    async def _tuple(self, session, row: GraphCheckpoint) -> CheckpointTuple:
+        writes = await session.execute(
+            select(GraphCheckpointWrite.task_id, GraphCheckpointWrite.channel,
+                   GraphCheckpointWrite.type, GraphCheckpointWrite.value)
+            .where(self._scope(GraphCheckpointWrite, row.thread_id, row.checkpoint_ns),
+                   GraphCheckpointWrite.checkpoint_id == row.checkpoint_id)
+            .order_by(GraphCheckpointWrite.task_id, GraphCheckpointWrite.idx)
+        )
+        configurable = {'thread_id': row.thread_id, 'checkpoint_ns': row.checkpoint_ns}
+        return CheckpointTuple(
+            config={'configurable': {**configurable, 'checkpoint_id': row.checkpoint_id}},
+            checkpoint=self.serde.loads_typed((row.type, row.checkpoint)),
+            metadata=self.serde.loads_typed((row.metadata_type, row.checkpoint_metadata)),
+            pending_writes=[(task_id, channel, self.serde.loads_typed((type_, value)))
+                            for task_id, channel, type_, value in writes],
+            parent_config=({'configurable': {**configurable, 'checkpoint_id': row.parent_checkpoint_id}}
+                           if row.parent_checkpoint_id else None),
+        )
+
+    async def aget_tuple(self, config: RunnableConfig) -> CheckpointTuple | None:
+        thread_id = config['configurable']['thread_id']
+        checkpoint_ns = config['configurable'].get('checkpoint_ns', '')
+        stmt = select(GraphCheckpoint).where(self._scope(GraphCheckpoint, thread_id, checkpoint_ns))
+        if checkpoint_id := get_checkpoint_id(config):
+            stmt = stmt.where(GraphCheckpoint.checkpoint_id == checkpoint_id)
+        else:
+            stmt = stmt.order_by(GraphCheckpoint.checkpoint_id.desc()).limit(1)
+        async with get_sessionmaker()() as session:
+            row = await session.scalar(stmt)
+            return await self._tuple(session, row) if row else None
+
+    async def alist(self, config: RunnableConfig | None, *, filter: dict[str, Any] | None = None,
+                    before: RunnableConfig | None = None, limit: int | None = None,
+                    ) -> AsyncIterator[CheckpointTuple]:
+        stmt = select(GraphCheckpoint).order_by(GraphCheckpoint.checkpoint_id.desc())
+        if config:
+            stmt = stmt.where(GraphCheckpoint.thread_id == config['configurable']['thread_id'])
+            if (checkpoint_ns := config['configurable'].get('checkpoint_ns')) is not None:
+                stmt = stmt.where(GraphCheckpoint.checkpoint_ns == checkpoint_ns)
+            if checkpoint_id := get_checkpoint_id(config):
+                stmt = stmt.where(GraphCheckpoint.checkpoint_id == checkpoint_id)
+        if before and (before_id := get_checkpoint_id(before)):
+            stmt = stmt.where(GraphCheckpoint.checkpoint_id < before_id)
+        async with get_sessionmaker()() as session:
+            for row in await session.scalars(stmt):
+                if limit is not None and limit <= 0:
+                    break
+                item = await self._tuple(session, row)
+                if filter and not all(item.metadata.get(k) == v for k, v in filter.items()):
+                    continue
+                if limit is not None:
+                    limit -= 1
+                yield item
+
+    async def aput(self, config: RunnableConfig, checkpoint: Checkpoint,
+                   metadata: CheckpointMetadata, new_versions: ChannelVersions) -> RunnableConfig:
+        thread_id = config['configurable']['thread_id']
+        checkpoint_ns = config['configurable'].get('checkpoint_ns', '')
+        type_, data = self.serde.dumps_typed(checkpoint)
+        metadata_type, metadata_data = self.serde.dumps_typed(get_checkpoint_metadata(config, metadata))
+        values = {'thread_id': thread_id, 'checkpoint_ns': checkpoint_ns,
+                  'checkpoint_id': checkpoint['id'],
+                  'parent_checkpoint_id': config['configurable'].get('checkpoint_id'),
+                  'type': type_, 'checkpoint': data,
+                  'metadata_type': metadata_type, 'checkpoint_metadata': metadata_data}
+        stmt = insert(GraphCheckpoint).values(values)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[GraphCheckpoint.thread_id, GraphCheckpoint.checkpoint_ns,
+                            GraphCheckpoint.checkpoint_id],
+            set_={key: stmt.excluded[key] for key in
+                  ('type', 'checkpoint', 'metadata_type', 'checkpoint_metadata')} | {'updated_at': func.now()},
+        )
+        kept = (select(GraphCheckpoint.checkpoint_id)
+                .where(self._scope(GraphCheckpoint, thread_id, checkpoint_ns))
+                .order_by(GraphCheckpoint.checkpoint_id.desc())
+                .limit(self.keep_last))
+        async with get_sessionmaker()() as session:
+            await session.execute(stmt)
+            await session.execute(
+                delete(GraphCheckpoint)
+                .where(self._scope(GraphCheckpoint, thread_id, checkpoint_ns),
+                       GraphCheckpoint.checkpoint_id.not_in(kept.scalar_subquery()))
+            )
+            await session.execute(
+                delete(GraphCheckpointWrite)
+                .where(self._scope(GraphCheckpointWrite, thread_id, checkpoint_ns),
+                       GraphCheckpointWrite.checkpoint_id.not_in(kept.scalar_subquery()))
+            )
+            await session.commit()
+        return {'configurable': {'thread_id': thread_id, 'checkpoint_ns': checkpoint_ns,
+                                 'checkpoint_id': checkpoint['id']}}
+
+    async def aput_writes(self, config: RunnableConfig, writes: Sequence[tuple[str, Any]],
+                          task_id: str, task_path: str = '') -> None:
+        if not writes:
+            return
+        configurable = config['configurable']
+        rows = []
+        for idx, (channel, value) in enumerate(writes):
+            type_, data = self.serde.dumps_typed(value)
+            rows.append({'thread_id': configurable['thread_id'],
+                         'checkpoint_ns': configurable.get('checkpoint_ns', ''),
+                         'checkpoint_id': configurable['checkpoint_id'],
+                         'task_id': task_id, 'idx': WRITES_IDX_MAP.get(channel, idx),
+                         'channel': channel, 'type': type_, 'value': data, 'task_path': task_path})
+        stmt = insert(GraphCheckpointWrite).values(rows)
+        index_elements = [GraphCheckpointWrite.thread_id, GraphCheckpointWrite.checkpoint_ns,
+                          GraphCheckpointWrite.checkpoint_id, GraphCheckpointWrite.task_id,
+                          GraphCheckpointWrite.idx]
+        # Special writes (errors, interrupts) replace the previous ones; regular
+        # writes are only stored once, as in InMemorySaver.
+        if all(channel in WRITES_IDX_MAP for channel, _ in writes):
+            stmt = stmt.on_conflict_do_update(
+                index_elements=index_elements,
+                set_={key: stmt.excluded[key] for key in ('channel', 'type', 'value', 'task_path')})
+        else:
+            stmt = stmt.on_conflict_do_nothing(index_elements=index_elements)
+        async with get_sessionmaker()() as session:
+            await session.execute(stmt)
+            await session.commit()
+
+    async def adelete_thread(self, thread_id: str) -> None:
+        async with get_sessionmaker()() as session:
+            await session.execute(delete(GraphCheckpointWrite).where(GraphCheckpointWrite.thread_id == thread_id))
+            await session.execute(delete(GraphCheckpoint).where(GraphCheckpoint.thread_id == thread_id))
+            await session.commit()
+
+    async def prune(self, ttl: float = CHECKPOINT_TTL) -> int:
+        """Delete the checkpoints of threads idle for more than `ttl` seconds."""
+        cutoff = datetime.now() - timedelta(seconds=ttl)
+        async with get_sessionmaker()() as session:
+            result = await session.execute(
+                delete(GraphCheckpoint).where(GraphCheckpoint.updated_at < cutoff))
+            await session.execute(
+                delete(GraphCheckpointWrite).where(~exists().where(
+                    GraphCheckpoint.thread_id == GraphCheckpointWrite.thread_id,
+                    GraphCheckpoint.checkpoint_ns == GraphCheckpointWrite.checkpoint_ns,
+                    GraphCheckpoint.checkpoint_id == GraphCheckpointWrite.checkpoint_id,
+                )))
+            await session.commit()
+        return result.rowcount
+
+
+def get_checkpointer() -> BaseCheckpointSaver:
+    """The checkpointer selected by CHECKPOINT_BACKEND: 'memory' (default) or 'postgres'."""
+    if CHECKPOINT_BACKEND == 'postgres':
+        return PostgresSaver()
+    if CHECKPOINT_BACKEND != 'memory':
+        raise ValueError(f'Unknown CHECKPOINT_BACKEND: {CHECKPOINT_BACKEND!r}')
+    return BoundedMemorySaver()
+
+
+async def main():
+    rows = await PostgresSaver().prune()
+    await dispose_engine()
+    print(f'graph_checkpoints pruned: {rows} rows.')
+
+if __name__ == '__main__':
+    asyncio.run(main())
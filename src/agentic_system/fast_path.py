@@ -0,0 +1,135 @@
+import re
+import unicodedata
+
+from src.agentic_system.basemodels import ActionOptions, UnitOptions, UpdateBaseModel
+
+# Rule-based parser for the most common single-item commands. Anything it
+# is not sure about returns None and goes through the LLM as before.
+
+ADD_VERBS = (
+    'adiciona', 'adicionar', 'adicione', 'acrescenta', 'acrescentar', 'acrescente',
+    'coloca', 'colocar', 'coloque', 'poe', 'por', 'inclui', 'incluir', 'inclua',
+    'comprei', 'add',
+)
+SUBTRACT_VERBS = (
+    'tira', 'tirar', 'tire', 'retira', 'retirar', 'retire', 'remove', 'remover',
+    'remova', 'subtrai', 'subtrair', 'subtraia', 'usei', 'gastei', 'consumi',
+    'subtract', 'take', 'use', 'used',
+)
+RENAME_VERBS = (
+    'renomeia', 'renomear', 'renomeie', 'muda o nome de', 'mudar o nome de',
+    'troca o nome de', 'trocar o nome de', 'rename',
+)
+
+UNIT_SYNONYMS = {unit.value: unit for unit in UnitOptions}
+UNIT_SYNONYMS.update({
+    'u': UnitOptions.UNIDADES, 'unidade': UnitOptions.UNIDADES, 'unidades': UnitOptions.UNIDADES,
+    'unit': UnitOptions.UNIDADES, 'units': UnitOptions.UNIDADES,
+    'gr': UnitOptions.GRAMAS, 'grama': UnitOptions.GRAMAS, 'gramas': UnitOptions.GRAMAS,
+    'gram': UnitOptions.GRAMAS, 'grams': UnitOptions.GRAMAS,
+    'quilo': UnitOptions.KILOGRAMAS, 'quilos': UnitOptions.KILOGRAMAS,
+    'kilo': UnitOptions.KILOGRAMAS, 'kilos': UnitOptions.KILOGRAMAS,
+    'quilograma': UnitOptions.KILOGRAMAS, 'quilogramas': UnitOptions.KILOGRAMAS,
+    'kilograma': UnitOptions.KILOGRAMAS, 'kilogramas': UnitOptions.KILOGRAMAS,
+    'kgs': UnitOptions.KILOGRAMAS,
+    'litro': UnitOptions.LITROS, 'litros': UnitOptions.LITROS, 'lt': UnitOptions.LITROS,
+    'lts': UnitOptions.LITROS, 'liter': UnitOptions.LITROS, 'liters': UnitOptions.LITROS,
+    'mililitro': UnitOptions.MILILITROS, 'mililitros': UnitOptions.MILILITROS,
+    'metro': UnitOptions.METROS, 'metros': UnitOptions.METROS,
+    'centimetro': UnitOptions.CENTIMETROS, 'centimetros': UnitOptions.CENTIMETROS,
+    'milimetro': UnitOptions.MILIMETROS, 'milimetros': UnitOptions.MILIMETROS,
+    'libra': UnitOptions.POUND, 'libras': UnitOptions.POUND, 'lbs': UnitOptions.POUND,
+    'onca': UnitOptions.OUNCE, 'oncas': UnitOptions.OUNCE,
+    'duzia': UnitOptions.DUZIA, 'duzias': UnitOptions.DUZIA, 'dozen': UnitOptions.DUZIA,
+    'pacote': UnitOptions.PACOTE, 'pacotes': UnitOptions.PACOTE, 'pacotinho': UnitOptions.PACOTE,
+    'caixa': UnitOptions.CAIXA, 'caixas': UnitOptions.CAIXA, 'box': UnitOptions.CAIXA,
+    'sacos': UnitOptions.SACO, 'rolo': UnitOptions.ROLO, 'rolos': UnitOptions.ROLO,
+    'folhas': UnitOptions.FOLHA, 'pedaco': UnitOptions.PEDACO, 'pedacos': UnitOptions.PEDACO,
+})
+
+
+def _fold(text: str) -> str:
+    # Strips accents one character at a time so positions still line up
+    # with the original text, which keeps the accents in item names.
+    return ''.join(unicodedata.normalize('NFKD', c)[0] for c in text)
+
+
+def _alternation(words) -> str:
+    return '|'.join(re.escape(w) for w in sorted(words, key=len, reverse=True))
+
+
+_QUANTITY_RE = re.compile(
+    rf'^(?P<verb>{_alternation(ADD_VERBS + SUBTRACT_VERBS)})\s+'
+    r'(?P<quantity>\d+(?:[.,]\d+)?)\s*(?P<unit>[a-z0-9]+)\.?\s+'
+    r'(?:(?:de|do|da|dos|das|of)\s+)?(?P<item>.+)$'
+)
+_RENAME_RE = re.compile(
+    rf'^(?:{_alternation(RENAME_VERBS)})\s+(?:o\s+item\s+|the\s+item\s+)?'
+    r'(?P<old>.+?)\s+(?:para|pra|to)\s+(?P<new>.+)$'
+)
+_STOCK_SUFFIX_RE = re.compile(
+    r'\s+(?:ao|no|do|pro|para o|from the|to the|from|to)\s+(?:estoque|invent[aá]rio|inventory|stock)$'
+)
+# More than one item, a second quantity or a question: leave it to the LLM.
+_AMBIGUOUS_RE = re.compile(r'[,;?!]|\d|\s(?:e|and|ou|or|mais|com)\s')
+# A location or filler after the item ("na geladeira", "pra mim") would end
+# up in its name; only the stock endings above are stripped, the rest goes
+# to the LLM.
+_LOCATION_RE = re.compile(
+    r'\s(?:na|no|nas|nos|num|numa|em|pra|pro|para|dentro|embaixo|atras|aqui|la|lá|mim|me'
+    r'|in|on|at|into|to|for|inside|here|there)\s'
+)
+
+# Courtesy and time words ("por favor", "hoje", "de novo") would too; they
+# are matched on the accent-folded text.
+_FILLER_RE = re.compile(
+    r'\s(?:por favor|pfv|pf|obrigad[oa]|hoje|ontem|amanha|agora|ja|tambem|ainda|de novo|novamente'
+    r'|please|pls|thanks|today|yesterday|tomorrow|now|also|too|again)\s'
+)
+_ARTICLE_RE = re.compile(r'^(?:o|a|os|as|um|uma|uns|umas|the|an)\s+')
+
+
+def _clean_item(item: str) -> str | None:
+    item = _STOCK_SUFFIX_RE.sub('', item.strip().rstrip('.')).strip()
+    item = _ARTICLE_RE.sub('', item)
+    padded = f' {item} '
+    if (not item or _AMBIGUOUS_RE.search(padded) or _LOCATION_RE.search(padded)
+            or _FILLER_RE.search(_fold(padded)) or len(item.split()) > 4):
+        return None
+    return item
+
+
+def _update(action: ActionOptions, item_name: str, quantity=None,
+            unit: UnitOptions = UnitOptions.UNIDADES,
+            old_item_name=None, new_item_name=None) -> UpdateBaseModel:
+    return UpdateBaseModel(action=action, item_name=item_name, quantity=quantity, unit=unit,
+                           old_item_name=old_item_name, new_item_name=new_item_name,
+                           category=None, description=None, location=None)
+
+
+def parse_fast_path(message: str) -> list[UpdateBaseModel] | None:
+    """Parse simple add/subtract/rename commands without the LLM, or return None."""
+    original = re.sub(r'\s+', ' ', message.lower()).strip().rstrip('.')
+    text = _fold(original)
+    if not text or len(text) != len(original):
+        return None
+
+    match = _QUANTITY_RE.match(text)
+    if match:
+        unit = UNIT_SYNONYMS.get(match['unit'])
+        item = _clean_item(original[match.start('item'):])
+        if unit is None or item is None:
+            return None
+        quantity = float(match['quantity'].replace(',', '.'))
+        action = ActionOptions.ADD if match['verb'] in ADD_VERBS else ActionOptions.SUBTRACT
+        return [_update(action, item, quantity=quantity, unit=unit)]
+
+    match = _RENAME_RE.match(text)
+    if match and len(re.findall(r'\s(?:para|pra|to)\s', text)) == 1:
+        old = _clean_item(original[match.start('old'):match.end('old')])
+        new = _clean_item(original[match.start('new'):])
+        if old is None or new is None:
+            return None
+        return [_update(ActionOptions.RENAME, old, old_item_name=old, new_item_name=new)]
+
+    return None
@@ -0,0 +1,134 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+from functools import lru_cache
+from typing import TYPE_CHECKING
+
+from pydantic import BaseModel
+
+from src.database.cache import TTLCache
+from dotenv import load_dotenv
+load_dotenv()
+
+if TYPE_CHECKING:
+    from langchain_core.language_models.chat_models import BaseChatModel
+
+logger = logging.getLogger(__name__)
+
+
+@lru_cache
+def _schema_hash(basemodel: type[BaseModel] | None) -> str:
+    if basemodel is None:
+        return ''
+    schema = json.dumps(basemodel.model_json_schema(), sort_keys=True)
+    return hashlib.sha256(schema.encode()).hexdigest()
+
+
+class LLMCache:
+    """Exact-match cache of LLM outputs: an in-memory LRU in front of a SQLite file.
+
+    Keys cover the model name, temperature, system prompt, normalized human
+    text and output schema, so only identical requests share an answer.
+    """
+
+    def __init__(self, path: str, ttl: float, memory_size: int):
+        self.path = path
+        self.ttl = ttl
+        self.memory = TTLCache(maxsize=memory_size, ttl=ttl)
+        self.hits = 0
+        self.misses = 0
+        self.disk_hits = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._lock:
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS llm_cache ('
+                'key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)'
+            )
+            self._conn.execute(
+                'CREATE INDEX IF NOT EXISTS ix_llm_cache_expires_at ON llm_cache (expires_at)'
+            )
+            self._conn.commit()
+
+    @staticmethod
+    def key(llm: 'BaseChatModel', system: str, human: str,
+            basemodel: type[BaseModel] | None = None) -> str:
+        parts = [
+            getattr(llm, 'model_name', None) or getattr(llm, 'model', None) or type(llm).__name__,
+            str(getattr(llm, 'temperature', None)),
+            hashlib.sha256(system.encode()).hexdigest(),
+            re.sub(r'\s+', ' ', human).strip().casefold(),
+            _schema_hash(basemodel),
+        ]
+        return hashlib.sha256('\x1f'.join(parts).encode()).hexdigest()
+
+    # A failing disk (locked, full, corrupt file) must not fail the request:
+    # reads become misses and writes are skipped.
+    def _disk_get(self, key: str) -> str | None:
+        with self._lock:
+            try:
+                row = self._conn.execute(
+                    'SELECT value FROM llm_cache WHERE key = ? AND expires_at > ?',
+                    (key, time.time()),
+                ).fetchone()
+            except sqlite3.Error:
+                logger.warning('LLM cache read failed; treating it as a miss', exc_info=True)
+                return None
+        return row[0] if row else None
+
+    def _disk_set(self, key: str, value: str):
+        with self._lock:
+            try:
+                self._conn.execute(
+                    'INSERT OR REPLACE INTO llm_cache (key, value, expires_at) VALUES (?, ?, ?)',
+                    (key, value, time.time() + self.ttl),
+                )
+                self._conn.execute('DELETE FROM llm_cache WHERE expires_at <= ?', (time.time(),))
+                self._conn.commit()
+            except sqlite3.Error:
+                logger.warning('LLM cache write failed; skipping it', exc_info=True)
+                self._conn.rollback()
+
+    async def get(self, key: str) -> str | None:
+        value = self.memory.get(key)
+        if value is None:
+            value = await asyncio.to_thread(self._disk_get, key)
+            if value is not None:
+                self.disk_hits += 1
+                self.memory.set(key, value)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    async def set(self, key: str, value: str):
+        self.memory.set(key, value)
+        await asyncio.to_thread(self._disk_set, key, value)
+
+    def stats(self) -> dict:
+        return {'hits': self.hits, 'misses': self.misses,
+                'disk_hits': self.disk_hits, 'memory_entries': len(self.memory)}
+
+
+@lru_cache
+def get_llm_cache() -> LLMCache | None:
+    """The process-wide LLM cache, or None unless LLM_CACHE_ENABLED is set."""
+    if os.getenv('LLM_CACHE_ENABLED', '').lower() not in ('1', 'true', 'yes', 'on'):
+        return None
+    try:
+        return LLMCache(
+            path=os.getenv('LLM_CACHE_PATH', 'llm_cache.sqlite3'),
+            ttl=float(os.getenv('LLM_CACHE_TTL', str(7 * 24 * 3600))),
+            memory_size=int(os.getenv('LLM_CACHE_MEMORY_SIZE', '2048')),
+        )
+    except sqlite3.Error:
+        logger.warning('Could not open the LLM cache; running without it', exc_info=True)
+        return None
@@ -1,20 +1,18 @@
+from functools import lru_cache
 from uuid import UUID
-from typing import Union
+from typing import TYPE_CHECKING, Union
 from langchain_core.runnables import RunnableConfig
 
-from langchain_groq.chat_models import ChatGroq
-from langchain_openai.chat_models import ChatOpenAI
-
-from langgraph.graph import StateGraph, END, START
-from langgraph.checkpoint.memory import MemorySaver
-from langgraph.types import Send, Command
-
 from langchain_core.messages import AIMessage, HumanMessage
 from sqlalchemy.util import ellipses_string
 
 from src.agentic_system.basemodels import *
-from src.agentic_system.utils_async import (DatabaseHandler, llm_chain_call, 
+from src.agentic_system.utils_async import (ANSWER_TAG, DatabaseHandler, llm_chain_call, 
                                             struct_output_call)
+from src.agentic_system.sql_guard import QueryExecutionError, UnsafeQueryError
+from src.agentic_system.answer_renderer import QUERY_ANSWER_MODE, render_query_answer
+from src.agentic_system.fast_path import parse_fast_path
+from src.agentic_system.query_cache import query_cache, sql_key, result_key, answer_key
 from src.agentic_system.portuguese_prompts import *
 from src.agentic_system.states import *
 
@@ -22,73 +20,118 @@ from dotenv import load_dotenv
 _ = load_dotenv()
 import os
 
+if TYPE_CHECKING:
+    from langchain_core.language_models.chat_models import BaseChatModel
+    from langgraph.checkpoint.base import BaseCheckpointSaver
+
+# langgraph and the provider packages take seconds to import, so they are
+# only imported once a graph is built or a model is first called. The
+# clients are built on first use and reused.
 mixtral_name : str = os.getenv("MIXTRAL", "")
 l70_name = os.getenv("LLAMA3_70B", "")
 l8_name = os.getenv("LLAMA3_8B", "")
 gemma_name = os.getenv("GEMMA2", "")
 
-mix = ChatGroq(temperature=0, 
-                   model = mixtral_name, 
-               api_key = os.getenv('GROQ_KEY', "")  # pyright: ignore[reportArgumentType]
-               )
-l70b = ChatGroq(temperature=0, 
-                   model = l70_name, 
-                   api_key= os.getenv('GROQ_KEY', ""),  # pyright: ignore[reportArgumentType]
-                   )
-l8b = ChatGroq(temperature=0, 
-                   model = l8_name, 
-                   api_key= os.getenv('GROQ_KEY', ""),  # pyright: ignore[reportArgumentType]
-                   )
-gemma = ChatGroq(temperature=0, 
-                   model = gemma_name, 
-                   api_key= os.getenv('GROQ_KEY', ""),  # pyright: ignore[reportArgumentType]
-                   )
-gpt = ChatOpenAI(temperature=0,
-                 api_key= os.getenv('OPENAI_KEY', ""),  # pyright: ignore[reportArgumentType]
-                 verbose=True,
-                 model='gpt-4o-mini'
-                 )
-db_handler = DatabaseHandler()
+@lru_cache
+def get_groq_llm(model_name: str) -> 'BaseChatModel':
+    from langchain_groq.chat_models import ChatGroq
+    return ChatGroq(temperature=0, 
+                    model = model_name, 
+                    api_key= os.getenv('GROQ_KEY', ""),  # pyright: ignore[reportArgumentType]
+                    )
+
+def get_mix() -> 'BaseChatModel':
+    return get_groq_llm(mixtral_name)
+
+def get_l70b() -> 'BaseChatModel':
+    return get_groq_llm(l70_name)
+
+def get_l8b() -> 'BaseChatModel':
+    return get_groq_llm(l8_name)
+
+def get_gemma() -> 'BaseChatModel':
+    return get_groq_llm(gemma_name)
+
+@lru_cache
+def get_gpt() -> 'BaseChatModel':
+    from langchain_openai.chat_models import ChatOpenAI
+    return ChatOpenAI(temperature=0,
+                      api_key= os.getenv('OPENAI_KEY', ""),  # pyright: ignore[reportArgumentType]
+                      verbose=True,
+                      model='gpt-4o-mini'
+                      )
+
+@lru_cache
+def get_db_handler() -> DatabaseHandler:
+    return DatabaseHandler()
 
 # Handlers:
 async def handle_update(task_description:str, user_id:str | UUID):
     system = update_system
     human = f'TASK: {task_description}'
-    response = await struct_output_call(system=system, human=human, llm=l70b, basemodel=UpdateBaseModel)
+    response = await struct_output_call(system=system, human=human, llm=get_l70b(), basemodel=UpdateBaseModel)
     update = response['parsed']
     tokens = response['raw'].usage_metadata['total_tokens']
-    await db_handler.add_total_tokens(user_id=user_id, n_tokens=tokens)
+    get_db_handler().record_tokens(user_id=user_id, n_tokens=tokens)
     return {'updates':[update]}
 
 async def handle_query(task_description:str, user_id:Union[str, UUID] , **kwargs):
-    system = query_system.format(user_id=user_id)
-    human = f'TASK: {task_description}'
-    response = await struct_output_call(system=system, human=human, llm=l70b, basemodel=SQLQueryBaseModel)
-    query = response['parsed']
-    tokens = response['raw'].usage_metadata['total_tokens']
-    await db_handler.add_total_tokens(user_id=user_id, n_tokens=tokens)
-    query_result = await db_handler.query(query.query)
-    treated_answer = await llm_chain_call(system=treat_query_system, 
-                                    human=f'Tarefa requisitada: {task_description}, comando SQL executado:{query.query} e resultado da query: {str(query_result)}', 
-                                    llm=l70b)
-    treated_answer.role = "assistant"
-    await db_handler.add_total_tokens(user_id=user_id, n_tokens=treated_answer.usage_metadata['total_tokens'])
-    return {'messages':[treated_answer], 'sql_queries':[query],'sql_results':[query_result]}
-
-async def handle_chatting(task_description:str, chat_history:str, user_id:Union[str, UUID] , **kwargs):
-    user_name = await db_handler.user_name(user_id)
+    version = await get_db_handler().inventory_version(user_id)
+
+    sql = query_cache.get(sql_key(user_id, version, task_description))
+    if sql is None:
+        system = query_system.format(user_id=user_id)
+        human = f'TASK: {task_description}'
+        response = await struct_output_call(system=system, human=human, llm=get_l70b(), basemodel=SQLQueryBaseModel)
+        sql = response['parsed'].query
+        tokens = response['raw'].usage_metadata['total_tokens']
+        get_db_handler().record_tokens(user_id=user_id, n_tokens=tokens)
+        query_cache.set(sql_key(user_id, version, task_description), sql)
+    query = SQLQueryBaseModel(query=sql)
+
+    cached_answer = query_cache.get(answer_key(user_id, version, sql, task_description))
+    query_result = query_cache.get(result_key(user_id, version, sql))
+    if cached_answer is not None and query_result is not None:
+        treated_answer = AIMessage(content=cached_answer, role="assistant")
+        return {'messages':[treated_answer], 'sql_queries':[query],'sql_results':[query_result.as_table()]}
+
+    table = None
+    if query_result is None:
+        try:
+            query_result = await get_db_handler().query(sql, user_id=user_id)
+            query_cache.set(result_key(user_id, version, sql), query_result)
+        except (UnsafeQueryError, QueryExecutionError) as e:
+            # Don't keep serving a query that fails; the next ask regenerates it.
+            query_cache.pop(sql_key(user_id, version, task_description))
+            table = f'Não foi possível executar a consulta: {e}'
+    table = table or query_result.as_table()
+
+    answer = None
+    if query_result is not None and QUERY_ANSWER_MODE == 'template':
+        answer = render_query_answer(query_result.columns, query_result.rows, query_result.truncated)
+    if answer is None:
+        treated_answer = await llm_chain_call(system=treat_query_system, 
+                                        human=f'Tarefa requisitada: {task_description}, comando SQL executado:{sql} e resultado da query: {table}', 
+                                        llm=get_l70b())
+        get_db_handler().record_tokens(user_id=user_id, n_tokens=(treated_answer.usage_metadata or {}).get('total_tokens', 0))
+        treated_answer.role = "assistant"
+        answer = treated_answer.content
+    else:
+        treated_answer = AIMessage(content=answer, role="assistant")
+    query_cache.set(answer_key(user_id, version, sql, task_description), answer)
+    return {'messages':[treated_answer], 'sql_queries':[query],'sql_results':[table]}
+
+async def handle_chatting(task_description:str, chat_history:str, user_id:Union[str, UUID] , user_name:str | None = None, **kwargs):
+    user_name = user_name or await get_db_handler().user_name(user_id)
     system = chatting_system.format(chat_history=chat_history)
     human = f'user {user_name} message: {task_description}'
-    chat_answer = await llm_chain_call(system=system, human=human, llm=l70b)
-    await db_handler.add_total_tokens(user_id=user_id, n_tokens=chat_answer.usage_metadata['total_tokens'])
+    chat_answer = await llm_chain_call(system=system, human=human, llm=get_l70b())
+    get_db_handler().record_tokens(user_id=user_id, n_tokens=(chat_answer.usage_metadata or {}).get('total_tokens', 0))
     chat_answer.role = "assistant"
     return {'messages':[chat_answer]}
 
 async def handle_subtract(user_id, item_name, quantity, **kwargs):
-    existing_item, message_not_found = await db_handler.check_existing_item(user_id=user_id, item_name=item_name)
-    if existing_item:
-        return await db_handler.subtract_to_existing_item(user_id=user_id, item_name=item_name, quantity=quantity)
-    return message_not_found
+    return await get_db_handler().subtract_to_existing_item(user_id=user_id, item_name=item_name, quantity=quantity)
 
 async def handle_add(user_id: int,
                      item_name: str,
@@ -99,40 +142,53 @@ async def handle_add(user_id: int,
                      loc: str | None = None,
                      **kwargs):
     
-    is_in_db, _ = await db_handler.check_existing_item(user_id=user_id, item_name=item_name)
-
-    if is_in_db:
-        return await db_handler.add_to_existing_item(user_id=user_id, item_name=item_name, quantity=quantity)
-    return await db_handler.creating_new_item(user_id=user_id, 
-                                              item_name=item_name, 
-                                              quantity=quantity, 
-                                              desc=desc, loc=loc, 
-                                              unit=unit, 
-                                              category= category)
+    return await get_db_handler().upsert_item(user_id=user_id, 
+                                        item_name=item_name, 
+                                        quantity=quantity, 
+                                        desc=desc, loc=loc, 
+                                        unit=unit, 
+                                        category= category)
 
 async def handle_discard_all(user_id, item_name, **kwargs):
-    existing_item, message_not_found = await db_handler.check_existing_item(user_id=user_id, item_name=item_name)
-    if existing_item:
-        return await db_handler.discard_all_to_existing_item(user_id=user_id, item_name=item_name)
-    return message_not_found
+    return await get_db_handler().discard_all_to_existing_item(user_id=user_id, item_name=item_name)
 
 async def handle_rename(user_id, old_item_name, new_item_name, **kwargs):
-    return await db_handler.renaming_existing_item(user_id=user_id, old_item_name=old_item_name, new_item_name=new_item_name)
+    return await get_db_handler().renaming_existing_item(user_id=user_id, old_item_name=old_item_name, new_item_name=new_item_name)
 
 async def handle_change_unit(user_id, item_name, unit, **kwargs):
-    return await db_handler.change_unit(user_id=user_id, item_name=item_name, unit=unit)
+    return await get_db_handler().change_unit(user_id=user_id, item_name=item_name, unit=unit)
 
 # Nodes and Conditions:
 
+async def fast_path(state: OverallState, config: RunnableConfig):
+    updates = parse_fast_path(state['user_input'])
+    if not updates:
+        return {'fast_updates': []}
+    user_id = config["configurable"].get("user_id", None)
+    human_message = HumanMessage(content=state['user_input'], role='user')
+    return {'fast_updates': updates,
+            'user_id': user_id,
+            'messages':[human_message],
+            'updates':['<ERASELISTNOW>'],
+            'sql_queries':['<ERASELISTNOW>'],
+            'sql_results':['<ERASELISTNOW>']}
+
+def route_fast_path(state: OverallState):
+    from langgraph.types import Send
+    updates = state.get('fast_updates', [])
+    if updates:
+        return [Send('process_update', {'update': u}) for u in updates]
+    return 'extract_tasks'
+
 async def extract_tasks(state: OverallState, config: RunnableConfig):
     user_id = config["configurable"].get("user_id", None)
     user_input = state['user_input']
     human_message = HumanMessage(content=user_input, role='user')
     system = extract_tasks_system
-    response = await struct_output_call(system=system, human=user_input, llm=l70b, basemodel=ListTaskModel)
+    response = await struct_output_call(system=system, human=user_input, llm=get_l70b(), basemodel=ListTaskModel)
     task_list = response['parsed']
     tokens = response['raw'].usage_metadata['total_tokens']
-    await db_handler.add_total_tokens(user_id=user_id, n_tokens=tokens)
+    get_db_handler().record_tokens(user_id=user_id, n_tokens=tokens)
     return {'task_list': task_list.task_list, 
             'user_id': user_id, 
             'messages':[human_message],
@@ -141,6 +197,7 @@ async def extract_tasks(state: OverallState, config: RunnableConfig):
             'sql_results':['<ERASELISTNOW>']}
 
 def send_tasks(state:OverallState):
+    from langgraph.types import Send
     return [Send('map_tasks',
                  {'task': t, 'messages': state['messages']}) 
              for t in state['task_list']
@@ -163,9 +220,12 @@ async def map_tasks(state: TaskState, config:RunnableConfig):
                 'query':handle_query, 
                 'chatting':handle_chatting}
     handler = task_map.get(label)
-    return await handler(user_id=user_id, chat_history=chat_history, task_description=task_description)
+    return await handler(user_id=user_id, chat_history=chat_history, task_description=task_description,
+                         user_name=config['configurable'].get('user_name'))
 
 def agg_tasks(state: OverallState):
+    from langgraph.graph import END
+    from langgraph.types import Command, Send
     updates = state.get('updates',[])
     if updates:
         c = Command(goto=[Send("process_update", {"update": u}) for u in updates])
@@ -211,12 +271,17 @@ async def process_update(state: UpdateState, config: RunnableConfig):
     return {'messages':[assistant_msg]}
 
 class Graph:
-    def __init__(self):
-        memory = MemorySaver()
+    def __init__(self, checkpointer: 'BaseCheckpointSaver | None' = None):
+        from langgraph.graph import StateGraph, END, START
+        from src.agentic_system.checkpointer import get_checkpointer
+
+        memory = checkpointer or get_checkpointer()
         graph = StateGraph(OverallState)
 
+        graph.add_node('fast_path', fast_path)
+        graph.add_edge(START, 'fast_path')
         graph.add_node('extract_tasks', extract_tasks)
-        graph.add_edge(START, 'extract_tasks')
+        graph.add_conditional_edges('fast_path', route_fast_path, ['extract_tasks', 'process_update'])
         graph.add_node('map_tasks', map_tasks)
         graph.add_conditional_edges('extract_tasks',send_tasks, ['map_tasks'])
         graph.add_node('agg_tasks',agg_tasks)
@@ -228,6 +293,32 @@ class Graph:
     async def async_invoking(self, config:Config, message:str):     
         await self.graph.ainvoke(input={'user_input':message}, config=config)
  
+    async def async_streaming(self, config:Config, message:str):
+        """Run the graph like async_invoking, yielding the answer text so far whenever it grows.
+
+        Tokens of the answering LLM calls arrive as they are generated; the
+        messages of the other nodes (updates, rendered query results) are
+        added when their node finishes.
+        """
+        parts, streamed = {}, set()
+        async for mode, chunk in self.graph.astream(input={'user_input':message}, config=config,
+                                                    stream_mode=['messages', 'updates']):
+            if mode == 'messages':
+                token, metadata = chunk
+                if ANSWER_TAG not in metadata.get('tags', []) or not isinstance(token.content, str):
+                    continue
+                streamed.add(token.id)
+                parts[token.id] = parts.get(token.id, '') + token.content
+            else:
+                for update in chunk.values():
+                    messages = update.get('messages', []) if isinstance(update, dict) else []
+                    for m in messages:
+                        if isinstance(m, AIMessage) and m.id not in streamed:
+                            parts[len(parts)] = m.content
+            text = '\n'.join(p for p in parts.values() if p)
+            if text:
+                yield text
+
     async def async_state(self, config:Config):
         return await self.graph.aget_state(config=config)
     
@@ -240,3 +331,8 @@ class Graph:
             else:
                 last_ia_messages+=f"{m.content} \n"
         return last_ia_messages
+
+@lru_cache
+def get_workflow() -> Graph:
+    """The process-wide graph, compiled on first use."""
+    return Graph()
@@ -0,0 +1,34 @@
+import os
+import re
+from typing import Union
+from uuid import UUID
+
+from src.database.cache import SizedLRUCache
+from dotenv import load_dotenv
+load_dotenv()
+
+# Entries are keyed by the user's inventory version, so any write to the
+# inventory makes the older entries unreachable; LRU eviction reclaims them.
+query_cache = SizedLRUCache(
+    max_bytes=int(os.getenv('QUERY_CACHE_MAX_BYTES', str(16 * 1024 * 1024)))
+)
+
+
+def normalize_question(question: str) -> str:
+    return re.sub(r'\s+', ' ', question).strip(' ?!.').lower()
+
+
+def normalize_sql(sql: str) -> str:
+    return re.sub(r'\s+', ' ', sql).strip().rstrip(';').strip()
+
+
+def sql_key(user_id: Union[str, UUID], version: int, question: str):
+    return ('sql', str(user_id), version, normalize_question(question))
+
+
+def result_key(user_id: Union[str, UUID], version: int, sql: str):
+    return ('result', str(user_id), version, normalize_sql(sql))
+
+
+def answer_key(user_id: Union[str, UUID], version: int, sql: str, question: str):
+    return ('answer', str(user_id), version, normalize_sql(sql), normalize_question(question))
@@ -0,0 +1,125 @@
+import os
+import re
+
+from src.database.models import table_registry
+from dotenv import load_dotenv
+load_dotenv()
+
+SQL_QUERY_TIMEOUT_MS = int(os.getenv('SQL_QUERY_TIMEOUT_MS', '3000'))
+SQL_QUERY_MAX_ROWS = int(os.getenv('SQL_QUERY_MAX_ROWS', '100'))
+SQL_QUERY_MAX_COST = float(os.getenv('SQL_QUERY_MAX_COST', '100000'))
+# Role the generated SQL runs as (SET LOCAL ROLE); it may only SELECT from
+# inventory_items, so a query slipping past validate_select still cannot
+# read other tables. Created by build_db; empty runs as the app's own role.
+SQL_QUERY_ROLE = os.getenv('SQL_QUERY_ROLE', 'inventory_reader')
+
+ALLOWED_TABLE = 'inventory_items'
+
+_FORBIDDEN_WORDS = {
+    'insert', 'update', 'delete', 'merge', 'upsert', 'drop', 'alter', 'create',
+    'truncate', 'grant', 'revoke', 'copy', 'call', 'do', 'execute', 'prepare',
+    'vacuum', 'analyze', 'cluster', 'reindex', 'lock', 'set', 'reset', 'listen',
+    'notify', 'into', 'recursive', 'set_config', 'dblink', 'information_schema',
+}
+_FORBIDDEN_TABLES = {name for name in table_registry.metadata.tables if name != ALLOWED_TABLE}
+_WORD = re.compile(r'[a-z_][a-z0-9_$]*')
+
+
+class UnsafeQueryError(ValueError):
+    """The generated SQL was rejected before (or instead of) being executed."""
+
+
+class QueryExecutionError(RuntimeError):
+    """The database failed, rejected or cancelled (timeout) the generated SQL."""
+
+
+def _tokens(sql: str):
+    """Yield (kind, text) for the SQL outside of string literals and comments."""
+    i, n = 0, len(sql)
+    while i < n:
+        c = sql[i]
+        if c.isspace():
+            i += 1
+        elif sql.startswith('--', i):
+            end = sql.find('\n', i)
+            i = n if end == -1 else end + 1
+        elif sql.startswith('/*', i):
+            end = sql.find('*/', i + 2)
+            if end == -1:
+                raise UnsafeQueryError('Comentário SQL não terminado.')
+            i = end + 2
+        elif c == "'":
+            end = i + 1
+            while True:
+                end = sql.find("'", end)
+                if end == -1:
+                    raise UnsafeQueryError('Texto SQL não terminado.')
+                if sql.startswith("''", end):
+                    end += 2
+                    continue
+                break
+            # With standard_conforming_strings off a backslash escapes the
+            # quote, and the literal would end elsewhere than read here.
+            if '\\' in sql[i:end]:
+                raise UnsafeQueryError('Barras invertidas não são permitidas em textos SQL.')
+            yield 'string', sql[i:end + 1]
+            i = end + 1
+        elif c == '"':
+            end = sql.find('"', i + 1)
+            if end == -1:
+                raise UnsafeQueryError('Identificador SQL não terminado.')
+            yield 'word', sql[i + 1:end].lower()
+            i = end + 1
+        elif c.isalpha() or c == '_':
+            match = _WORD.match(sql.lower(), i)
+            # E'...' strings and U&'...' / U&"..." names are decoded by
+            # Postgres (backslash and Unicode escapes) and cannot be checked
+            # as written here.
+            if (match.group() == 'e' and sql.startswith("'", match.end())) or \
+                    (match.group() == 'u' and sql.startswith(("&'", '&"'), match.end())):
+                raise UnsafeQueryError('Textos e identificadores com escapes não são permitidos.')
+            yield 'word', match.group()
+            i = match.end()
+        else:
+            yield 'punct', c
+            i += 1
+
+
+def validate_select(sql: str) -> str:
+    """Check that `sql` is one read-only SELECT over inventory_items and return it trimmed."""
+    sql = sql.strip().rstrip(';').strip()
+    tokens = list(_tokens(sql))
+    words = [text for kind, text in tokens if kind == 'word']
+    if not words or words[0] not in ('select', 'with'):
+        raise UnsafeQueryError('Apenas consultas SELECT são permitidas.')
+    for index, (kind, text) in enumerate(tokens):
+        if kind == 'punct' and text in (';', '$'):
+            raise UnsafeQueryError('Apenas um comando SQL simples é permitido.')
+        if kind != 'word':
+            continue
+        if text in _FORBIDDEN_WORDS or text in _FORBIDDEN_TABLES:
+            raise UnsafeQueryError(f'Uso de "{text}" não é permitido na consulta.')
+        if text.startswith(('pg_', 'lo_')) or '_to_xml' in text:
+            raise UnsafeQueryError(f'Uso de "{text}" não é permitido na consulta.')
+        if text == ALLOWED_TABLE and index and tokens[index - 1] == ('punct', '.'):
+            raise UnsafeQueryError('Use a tabela inventory_items sem esquema.')
+        if text in ('share', 'update') and index and tokens[index - 1][1] == 'for':
+            raise UnsafeQueryError('Consultas com bloqueio não são permitidas.')
+    return sql
+
+
+def guarded_statement(sql: str, max_rows: int = SQL_QUERY_MAX_ROWS) -> str:
+    """Scope inventory_items to the bound :user_id and cap the rows returned.
+
+    The CTE shadows the real table for every reference inside the user's
+    query, so the user_id filter cannot be skipped. One extra row is
+    fetched so the caller can tell whether the result was truncated.
+    """
+    sql = validate_select(sql)
+    # Keep colons in the generated SQL from being read as bind parameters.
+    sql = re.sub(r'(?<![:\w\\]):(?=\w)', r'\\:', sql)
+    return (
+        f'WITH {ALLOWED_TABLE} AS ('
+        f'SELECT * FROM public.{ALLOWED_TABLE} WHERE user_id = :user_id) '
+        f'SELECT * FROM ({sql}) AS guarded_query LIMIT {int(max_rows) + 1}'
+    )
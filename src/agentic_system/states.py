@@ -21,6 +21,7 @@ class OverallState(TypedDict):
     updates: Annotated[List[UpdateBaseModel], add_or_erase]
     sql_queries: Annotated[List[SQLQueryBaseModel], add_or_erase]
     sql_results: Annotated[list, add_or_erase]
+    fast_updates: List[UpdateBaseModel]
 
 class TaskState(TypedDict):
     task: TaskModel
@@ -1,40 +1,56 @@
-from functools import lru_cache
 from typing import Union
 from uuid import UUID
 from contextlib import asynccontextmanager
-from sqlalchemy import select
+from sqlalchemy import select, update, func, literal_column
 from sqlalchemy.sql import text
+from sqlalchemy.dialects.postgresql import insert
 
-from langchain_core.prompts import ChatPromptTemplate
-
-from src.database.models import InventoryItem, User, MetaLog
+from src.database.models import InventoryItem, User
+from src.database.usage import token_usage_writer
+from src.database.inventory_version import bump_inventory_version, get_inventory_version
+from src.agentic_system.sql_guard import (SQL_QUERY_MAX_COST, SQL_QUERY_MAX_ROWS,
+                                          SQL_QUERY_ROLE, SQL_QUERY_TIMEOUT_MS, QueryExecutionError,
+                                          UnsafeQueryError, guarded_statement)
 
 from pydantic import BaseModel
 
-from sqlalchemy.ext.asyncio import (create_async_engine, 
-                                    async_sessionmaker)
+from src.database.engine import get_engine, get_sessionmaker
 
 from decimal import Decimal
+from dataclasses import dataclass, field
+import json
 import os
+import sys
 from dotenv import load_dotenv
 load_dotenv()
 
-@lru_cache
-def get_uri():
-    return os.getenv('DATABASE_URL')
-
-def format_as_table(data: list) -> str:
+def format_as_table(data: list, truncated: bool = False) -> str:
     if not data:
         return """Resultado não encontrado. """
     
     rows = [", ".join(map(str, row)) for row in data]
+    if truncated:
+        rows.append(f"(Resultado truncado: apenas as primeiras {len(data)} linhas foram retornadas.)")
     return "\n".join(rows)
 
+@dataclass
+class QueryResult:
+    columns: list[str]
+    rows: list[tuple] = field(default_factory=list)
+    truncated: bool = False
+
+    def as_table(self) -> str:
+        return format_as_table(self.rows, truncated=self.truncated)
+
+    def __sizeof__(self) -> int:
+        # Counted by query_cache, which only looks one level deep.
+        return (object.__sizeof__(self) + sum(sys.getsizeof(c) for c in self.columns)
+                + sum(sys.getsizeof(row) + sum(sys.getsizeof(v) for v in row) for row in self.rows))
+
 class DatabaseHandler:
     def __init__(self):
-        uri = get_uri()
-        self.engine = create_async_engine(uri)
-        self.Session = async_sessionmaker(self.engine, expire_on_commit=False)
+        self.engine = get_engine()
+        self.Session = get_sessionmaker()
     @asynccontextmanager
     async def _get_session(self):
         session = self.Session()
@@ -76,21 +92,23 @@ class DatabaseHandler:
         new_item_name = new_item_name.lower()
         async with self._get_session() as session:
             existing_old_item = await session.scalar(
-                select(InventoryItem).where((InventoryItem.user_id==user_id) & 
-                (InventoryItem.name == old_item_name)))
+                select(InventoryItem).where(self._item_clause(user_id, old_item_name)))
         
             existing_new_item = await session.scalar(
-                select(InventoryItem).where((InventoryItem.user_id==user_id) &
-                (InventoryItem.name == new_item_name)))
+                select(InventoryItem).where(self._item_clause(user_id, new_item_name)))
             
-            if existing_old_item and not existing_new_item:
+            # Names are unique per user regardless of case, so a new name equal
+            # to the old one but for case is the same row.
+            if existing_old_item and (existing_new_item is None or existing_new_item is existing_old_item):
                 existing_old_item.name = new_item_name
+                await session.execute(bump_inventory_version(user_id))
                 await session.commit()
                 await session.refresh(existing_old_item)
                 message = f"""Item:{old_item_name} renomeado para: {existing_old_item.name}. """
 
             elif existing_old_item and existing_new_item:
                 existing_new_item.quantity += Decimal(existing_old_item.quantity)
+                await session.execute(bump_inventory_version(user_id))
                 await session.commit()
                 await session.refresh(existing_new_item)
                 
@@ -101,67 +119,95 @@ class DatabaseHandler:
                 message = f"""Item {old_item_name} não encontrado. """
         return message
 
+    @staticmethod
+    def _item_clause(user_id:Union[str, UUID], item_name:str):
+        return ((InventoryItem.user_id == user_id) &
+                (func.lower(InventoryItem.name) == item_name))
+
+    async def _current_item(self, session, user_id:Union[str, UUID], item_name:str):
+        # Only reached when a conditional UPDATE matched no row, to explain why.
+        return (await session.execute(
+            select(InventoryItem.quantity, InventoryItem.unit).where(
+                self._item_clause(user_id, item_name)))).one_or_none()
+
     async def add_to_existing_item(self, user_id:Union[str, UUID], item_name:str, quantity:int|float):
         item_name = item_name.lower()
+        stmt = (update(InventoryItem)
+                .where(self._item_clause(user_id, item_name))
+                .values(quantity=InventoryItem.quantity + quantity)
+                .returning(InventoryItem.quantity, InventoryItem.unit)
+                .execution_options(synchronize_session=False))
         async with self._get_session() as session:
-            item = await session.scalar(
-                select(InventoryItem).where((InventoryItem.user_id ==user_id) &
-                                                    (InventoryItem.name == item_name)))
-            current_quantity = Decimal(item.quantity)
-            plus_quantity = Decimal(quantity)
-            item.quantity = current_quantity + plus_quantity
-            await session.commit()
-            await session.refresh(item)
+            item = (await session.execute(stmt)).one_or_none()
+            if item:
+                await session.execute(bump_inventory_version(user_id))
+        if item:
             message = f"""Adicionado {quantity} {item.unit} ao item {item_name}, quantidade atual: {item.quantity}. """
+        else:
+            message = f"""Item '{item_name}' não existe no banco de dados. """
         return message
 
     async def subtract_to_existing_item(self, user_id:Union[str, UUID], item_name:str, quantity:int|float):
         item_name = item_name.lower()
+        stmt = (update(InventoryItem)
+                .where(self._item_clause(user_id, item_name) &
+                       (InventoryItem.quantity >= quantity))
+                .values(quantity=InventoryItem.quantity - quantity)
+                .returning(InventoryItem.quantity, InventoryItem.unit)
+                .execution_options(synchronize_session=False))
         async with self._get_session() as session:
-            item = await session.scalar(
-                select(InventoryItem).where((InventoryItem.user_id ==user_id) &
-                                                    (InventoryItem.name == item_name)))
-            if item.quantity >= Decimal(quantity):
-                item.quantity-= Decimal(quantity)
-                await session.commit()
-                await session.refresh(item)
-                
-                message = f"""Subtraido {quantity} {item.unit} do item {item_name}, quantidade atual: {item.quantity}. """
+            item = (await session.execute(stmt)).one_or_none()
+            if item:
+                await session.execute(bump_inventory_version(user_id))
             else:
-                message = f"""Quantidade {quantity} {item.unit} é maior que a quantidade do item 
-                {item_name}: quantidade Total {item.quantity} {item.unit}. """
+                current = await self._current_item(session, user_id, item_name)
+        if item:
+            message = f"""Subtraido {quantity} {item.unit} do item {item_name}, quantidade atual: {item.quantity}. """
+        elif current:
+            message = f"""Quantidade {quantity} {current.unit} é maior que a quantidade do item 
+            {item_name}: quantidade Total {current.quantity} {current.unit}. """
+        else:
+            message = f"""Item '{item_name}' não existe no banco de dados. """
         return message
 
     async def discard_all_to_existing_item(self, user_id:Union[str, UUID], item_name:str):
         item_name = item_name.lower()
+        stmt = (update(InventoryItem)
+                .where(self._item_clause(user_id, item_name) &
+                       (InventoryItem.quantity > 0))
+                .values(quantity=0)
+                .returning(InventoryItem.quantity)
+                .execution_options(synchronize_session=False))
         async with self._get_session() as session:
-            item = await session.scalar(
-                select(InventoryItem).where((InventoryItem.user_id ==user_id) &
-                                                    (InventoryItem.name == item_name)))
-            if item.quantity >= 0:
-                item.quantity = 0
-                await session.commit()
-                await session.refresh(item)
-                
-                message = f"Descartar todas as unidades do item {item_name}. "
+            item = (await session.execute(stmt)).one_or_none()
+            if item:
+                await session.execute(bump_inventory_version(user_id))
             else:
-                message = f"Quantidade de {item_name} já é 0. "
+                current = await self._current_item(session, user_id, item_name)
+        if item:
+            message = f"Descartar todas as unidades do item {item_name}. "
+        elif current:
+            message = f"Quantidade de {item_name} já é 0. "
+        else:
+            message = f"""Item '{item_name}' não existe no banco de dados. """
         return message
     
     
     async def change_unit(self, user_id:Union[str, UUID], item_name:str, unit: str):
         item_name = item_name.lower()
+        stmt = (update(InventoryItem)
+                .where(self._item_clause(user_id, item_name))
+                .values(unit=unit)
+                .returning(InventoryItem.unit)
+                .execution_options(synchronize_session=False))
         async with self._get_session() as session:
-            item = await session.scalar(
-                select(InventoryItem).where((InventoryItem.user_id ==user_id) &
-                                                    (InventoryItem.name == item_name)))
+            item = (await session.execute(stmt)).one_or_none()
             if item:
-                item.unit = unit
-                await session.commit()
-                await session.refresh(item)
-                message = f"""Unidade de {item_name} definido como {item.unit}. """
-            else:
-                message = f"""Item {item_name} não encontrado. """
+                await session.execute(bump_inventory_version(user_id))
+        if item:
+            message = f"""Unidade de {item_name} definido como {item.unit}. """
+        else:
+            message = f"""Item {item_name} não encontrado. """
         return message
     
     async def creating_new_item(self, user_id:Union[str, UUID], 
@@ -193,57 +239,184 @@ class DatabaseHandler:
                     category=category
                     )
             session.add(created_item)
+            await session.execute(bump_inventory_version(user_id))
             await session.commit()
             await session.refresh(created_item)
             message = f"""Item {created_item.name} criado com sucesso, quantidade atual: {created_item.quantity} {created_item.unit}. """
         return message
 
-    async def add_total_tokens(self, user_id:Union[str,UUID], n_tokens: int):
+    async def upsert_item(self, user_id:Union[str, UUID], 
+                          item_name:str, 
+                          quantity:int|float,
+                          category:str|None,
+                          desc:str|None, 
+                          loc:str|None, 
+                          unit:str|None):
+        """Create the item or add to its quantity in a single INSERT ... ON CONFLICT statement."""
+        item_name = item_name.lower()
+        if desc:
+            desc = desc.lower()
+        if loc:
+            loc = loc.lower()
+        if unit:
+            unit = unit.lower()
+        if not quantity:
+            quantity = 0
+        if not category:
+            category = "geral"
+        stmt = insert(InventoryItem).values(
+            user_id=user_id,
+            name=item_name,
+            description=desc,
+            location=loc,
+            quantity=quantity,
+            unit=unit,
+            category=category,
+        )
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[InventoryItem.user_id, func.lower(InventoryItem.name)],
+            set_={
+                'quantity': InventoryItem.quantity + stmt.excluded.quantity,
+                'updated_at': func.now(),
+            },
+        ).returning(
+            InventoryItem.name,
+            InventoryItem.quantity,
+            InventoryItem.unit,
+            literal_column('xmax = 0').label('inserted'),
+        )
         async with self._get_session() as session:
-            token_usage = MetaLog(
-                    user_id=user_id,
-                    n_tokens=n_tokens)
-            session.add(token_usage)
-            await session.commit()
-            await session.refresh(token_usage)
-            message = f"""Number of tokens used: {token_usage.n_tokens}. """
+            item = (await session.execute(stmt)).one()
+            await session.execute(bump_inventory_version(user_id))
+        if item.inserted:
+            message = f"""Item {item.name} criado com sucesso, quantidade atual: {item.quantity} {item.unit}. """
+        else:
+            message = f"""Adicionado {quantity} {item.unit} ao item {item.name}, quantidade atual: {item.quantity}. """
         return message
-   
-    async def query(self, query: str):
+
+    async def inventory_version(self, user_id:Union[str, UUID]) -> int:
         async with self._get_session() as session:
-            try:
-                result = await session.execute(text(query))
-                rows = result.fetchall()
-                formated_result = format_as_table(rows)
-                return formated_result
-            except Exception as e:
-                raise e
+            return await get_inventory_version(session, user_id)
+
+    def record_tokens(self, user_id:Union[str,UUID], n_tokens: int):
+        """Queue a MetaLog row; it is written in bulk off the request path."""
+        token_usage_writer.record(user_id=user_id, n_tokens=n_tokens)
+   
+    async def query(self, query: str, user_id:Union[str, UUID]) -> QueryResult:
+        """Run LLM-generated SQL in a guarded, read-only and time-boxed transaction.
+
+        Raises UnsafeQueryError when the SQL is not a single SELECT over
+        inventory_items or when the planner estimates it as too expensive,
+        and QueryExecutionError when the database rejects or cancels it.
+        """
+        statement = text(guarded_statement(query, max_rows=SQL_QUERY_MAX_ROWS))
+        params = {'user_id': UUID(str(user_id))}
+        try:
+            async with self._get_session() as session:
+                await session.execute(text('SET TRANSACTION READ ONLY'))
+                await session.execute(text(f'SET LOCAL statement_timeout = {int(SQL_QUERY_TIMEOUT_MS)}'))
+                if SQL_QUERY_ROLE:
+                    await session.execute(text(f'SET LOCAL ROLE "{SQL_QUERY_ROLE}"'))
+                plan = await session.scalar(
+                    text(f'EXPLAIN (FORMAT JSON) {statement.text}'), params)
+                if isinstance(plan, str):
+                    plan = json.loads(plan)
+                cost = plan[0]['Plan']['Total Cost']
+                if cost > SQL_QUERY_MAX_COST:
+                    raise UnsafeQueryError(f'Consulta muito custosa (custo estimado {cost:.0f}).')
+
+                result = await session.stream(statement, params)
+                rows, truncated = [], False
+                async for row in result:
+                    if len(rows) == SQL_QUERY_MAX_ROWS:
+                        truncated = True
+                        break
+                    rows.append(tuple(row))
+                columns = list(result.keys())
+                await result.close()
+        except UnsafeQueryError:
+            raise
+        except Exception as e:
+            raise QueryExecutionError(str(e)) from e
+        return QueryResult(columns=columns, rows=rows, truncated=truncated)
 
 
-from langchain_core.language_models.chat_models import BaseChatModel
+from functools import lru_cache
+from typing import TYPE_CHECKING
+
 from langchain_core.messages import AIMessage
 
-async def struct_output_call(system:str, human:str, llm:BaseChatModel, basemodel: BaseModel):
-    check_prompt = ChatPromptTemplate.from_messages(
-            [
-                ("system", system),
-                ("human", human),
-            ]
-        )
-    structured_llm = llm.with_structured_output(basemodel, include_raw=True)
-    chain = check_prompt | structured_llm
-    response = await chain.ainvoke({})
+if TYPE_CHECKING:
+    from langchain_core.language_models.chat_models import BaseChatModel
+    from langchain_core.runnables import Runnable
+
+from src.agentic_system.llm_cache import get_llm_cache
+
+# Tags the free-text calls whose tokens are streamed to the user.
+ANSWER_TAG = 'answer'
+
+# One template for every call: the system and human text are passed as
+# variables, so braces inside them are never parsed as placeholders.
+# Built on first use, as langchain_core.prompts is slow to import.
+@lru_cache
+def get_chat_prompt():
+    from langchain_core.prompts import ChatPromptTemplate
+    return ChatPromptTemplate.from_messages(
+        [
+            ("system", "{system}"),
+            ("human", "{human}"),
+        ]
+    )
 
+# Compiled chains per (llm, basemodel). Building with_structured_output
+# regenerates the JSON schema, so it is done once per pair and reused.
+_chains: dict[tuple[int, type[BaseModel] | None], tuple['BaseChatModel', 'Runnable']] = {}
+
+def get_chain(llm: 'BaseChatModel', basemodel: type[BaseModel] | None = None) -> 'Runnable':
+    key = (id(llm), basemodel)
+    entry = _chains.get(key)
+    # The llm is kept in the entry so its id cannot be reused by another object.
+    if entry is None or entry[0] is not llm:
+        if basemodel is None:
+            chain = get_chat_prompt() | llm
+        else:
+            chain = get_chat_prompt() | llm.with_structured_output(basemodel, include_raw=True)
+        entry = _chains[key] = (llm, chain)
+    return entry[1]
+
+def _cached_message(content: str = '') -> AIMessage:
+    # Cache hits cost nothing, so they report zero tokens to MetaLog.
+    return AIMessage(content=content,
+                     usage_metadata={'input_tokens': 0, 'output_tokens': 0, 'total_tokens': 0})
+
+async def struct_output_call(system:str, human:str, llm:'BaseChatModel', basemodel: BaseModel):
+    cache = get_llm_cache()
+    if cache:
+        key = cache.key(llm, system, human, basemodel)
+        cached = await cache.get(key)
+        if cached is not None:
+            return {'raw': _cached_message(), 
+                    'parsed': basemodel.model_validate_json(cached), 
+                    'parsing_error': None}
+
+    chain = get_chain(llm, basemodel)
+    response = await chain.ainvoke({'system': system, 'human': human})
+
+    if cache and response.get('parsed') is not None and not response.get('parsing_error'):
+        await cache.set(key, response['parsed'].model_dump_json())
     return response
 
-async def llm_chain_call(system:str, human:str, llm:BaseChatModel) -> AIMessage:
-    check_prompt = ChatPromptTemplate.from_messages(
-            [
-                ("system", system),
-                ("human", human),
-            ]
-        )
-    chain = check_prompt | llm
-    response = await chain.ainvoke({})
+async def llm_chain_call(system:str, human:str, llm:'BaseChatModel') -> AIMessage:
+    cache = get_llm_cache()
+    if cache:
+        key = cache.key(llm, system, human)
+        cached = await cache.get(key)
+        if cached is not None:
+            return _cached_message(cached)
+
+    chain = get_chain(llm)
+    response = await chain.ainvoke({'system': system, 'human': human}, config={'tags': [ANSWER_TAG]})
 
+    if cache and isinstance(response.content, str):
+        await cache.set(key, response.content)
     return response
\ No newline at end of file
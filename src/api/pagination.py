@@ -0,0 +1,22 @@
+import base64
+import json
+from http import HTTPStatus
+from typing import Any, Callable
+
+from fastapi import HTTPException
+
+
+def encode_cursor(last_id) -> str:
+    """Opaque keyset cursor pointing just after the row with `last_id`."""
+    payload = json.dumps({'id': str(last_id)}, separators=(',', ':'))
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor: str, id_type: Callable[[str], Any] = str):
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        return id_type(json.loads(base64.urlsafe_b64decode(padded))['id'])
+    except (ValueError, KeyError, TypeError):
+        raise HTTPException(
+            status_code=HTTPStatus.BAD_REQUEST, detail='Invalid cursor.'
+        )
@@ -14,6 +14,7 @@ from src.api.schemas import Token, Message, StripeChecker, TelegramId
 from src.api.security import (
     create_access_token,
     get_current_user,
+    user_claims,
     verify_password,
 )
 
@@ -32,13 +33,17 @@ async def login_for_access_token(form_data: OAuth2Form, session: T_Session, resp
             detail='Incorrect email or password',
         )
 
-    if not verify_password(form_data.password, user.hashed_password):
+    # Give the connection back to the pool while the hash is checked; the
+    # loaded user stays usable detached.
+    await session.close()
+
+    if not await verify_password(form_data.password, user.hashed_password):
         raise HTTPException(
             status_code=HTTPStatus.BAD_REQUEST,
             detail='Incorrect email or password',
         )
 
-    access_token = create_access_token(data={'sub': user.email})
+    access_token = create_access_token(data=user_claims(user))
 
     return {'access_token': access_token, 
             'token_type': 'bearer', 
@@ -49,7 +54,7 @@ async def login_for_access_token(form_data: OAuth2Form, session: T_Session, resp
 def refresh_access_token(
     user: User = Depends(get_current_user),
 ):
-    new_access_token = create_access_token(data={'sub': user.email})
+    new_access_token = create_access_token(data=user_claims(user))
 
     return {'access_token': new_access_token, 'token_type': 'bearer'}
 
@@ -62,7 +67,7 @@ async def telegram_access_token(form_data: OAuth2Form, session: T_Session, respo
             detail='Incorrect email or password',
         )
 
-    access_token = create_access_token(data={'sub': user.email})
+    access_token = create_access_token(data=user_claims(user))
 
     return {'access_token': access_token, 
             'token_type': 'bearer', 
@@ -2,25 +2,31 @@ from http import HTTPStatus
 from typing import Annotated
 from uuid import UUID
 from fastapi import APIRouter, Depends, HTTPException, Query
-from sqlalchemy import select
+from sqlalchemy import select, func, insert, update, delete
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from src.database.database import get_asession
+from src.database.inventory_version import bump_inventory_version
 from src.database.models import User, InventoryItem
 from src.api.schemas import (
     FilterItem,
+    ItemBulk,
+    ItemBulkResult,
     Message,
     ItemList,
     ItemPublic,
     ItemSchema,
     ItemUpdate,
 )
-from src.api.security import get_current_user
+from src.api.pagination import decode_cursor, encode_cursor
+from src.api.search import escape_like, fold_text, folded
+from src.api.security import Principal, get_current_principal
 
 router = APIRouter()
 
 T_Session = Annotated[AsyncSession, Depends(get_asession)]
-CurrentUser = Annotated[User, Depends(get_current_user)]
+CurrentUser = Annotated[Principal, Depends(get_current_principal)]
 
 router = APIRouter(prefix='/items', tags=['items'])
 
@@ -41,12 +47,87 @@ async def create_item(
         category=item.category,
     )
     session.add(db_item)
-    await session.commit()
+    try:
+        await session.execute(bump_inventory_version(user.id))
+        await session.commit()
+    except IntegrityError:
+        await session.rollback()
+        raise HTTPException(
+            status_code=HTTPStatus.CONFLICT, detail='Item name already exists.'
+        )
     await session.refresh(db_item)
 
     return db_item
 
 
+@router.post('/bulk', response_model=ItemBulkResult)
+async def bulk_items(
+    bulk: ItemBulk,
+    user: CurrentUser,
+    session: T_Session,
+):
+    """Apply creates, then patches, then deletes in one transaction."""
+    patches = {}
+    for patch in bulk.patch:
+        patches.setdefault(patch.id, {}).update(
+            patch.model_dump(exclude_unset=True, exclude={'id'}, mode='json'))
+    deletes = list(dict.fromkeys(bulk.delete))
+
+    touched = set(patches) | set(deletes)
+    if touched:
+        found = set(await session.scalars(
+            select(InventoryItem.id).where(InventoryItem.user_id == user.id,
+                                           InventoryItem.id.in_(touched))
+        ))
+        if found != touched:
+            raise HTTPException(
+                status_code=HTTPStatus.NOT_FOUND,
+                detail=f'Items not found: {sorted(touched - found)}.',
+            )
+
+    created = []
+    try:
+        if bulk.create:
+            created = (await session.scalars(
+                insert(InventoryItem).returning(InventoryItem, sort_by_parameter_order=True),
+                [{'user_id': user.id, **item.model_dump()} for item in bulk.create],
+            )).all()
+        patch_rows = [{'id': item_id, **values}
+                      for item_id, values in patches.items() if values]
+        if patch_rows:
+            await session.execute(update(InventoryItem), patch_rows)
+    except IntegrityError:
+        await session.rollback()
+        raise HTTPException(
+            status_code=HTTPStatus.CONFLICT, detail='Item name already exists.'
+        )
+
+    if deletes:
+        await session.execute(
+            delete(InventoryItem)
+            .where(InventoryItem.user_id == user.id, InventoryItem.id.in_(deletes))
+            .execution_options(synchronize_session=False)
+        )
+
+    if bulk.create or patches or deletes:
+        await session.execute(bump_inventory_version(user.id))
+
+    updated = []
+    deleted = set(deletes)
+    kept = [item_id for item_id in patches if item_id not in deleted]
+    if kept:
+        rows = {item.id: item for item in await session.scalars(
+            select(InventoryItem)
+            .where(InventoryItem.id.in_(kept))
+            .execution_options(populate_existing=True)
+        )}
+        updated = [rows[item_id] for item_id in kept]
+
+    await session.commit()
+
+    return {'created': created, 'updated': updated, 'deleted': deletes}
+
+
 @router.get('/', response_model=ItemList)
 async def list_items(
     session: T_Session,
@@ -55,28 +136,43 @@ async def list_items(
 ):
     query = select(InventoryItem).where(InventoryItem.user_id == user.id)
 
-    if item_filter.name:
-        query = query.filter(
-            InventoryItem.name.contains(item_filter.name))
-    if item_filter.quantity:
-        query = query.filter(
-            InventoryItem.quantity.contains(item_filter.quantity))
-    if item_filter.location:
-        query = query.filter(
-            InventoryItem.location.contains(item_filter.location))
-    if item_filter.description:
-        query = query.filter(
-            InventoryItem.description.contains(item_filter.description))
-    if item_filter.category:
-        query = query.filter(
-            InventoryItem.category.contains(item_filter.category))
-
-    result = await session.scalars(
-        query.offset(item_filter.offset).limit(item_filter.limit)
-    )
+    if item_filter.quantity is not None:
+        query = query.filter(InventoryItem.quantity == item_filter.quantity)
+    if item_filter.unit:
+        query = query.filter(InventoryItem.unit == item_filter.unit)
+
+    text_filters = [
+        (getattr(InventoryItem, field), fold_text(value))
+        for field in ('name', 'location', 'description', 'category')
+        if (value := getattr(item_filter, field))
+    ]
+    if item_filter.match == 'similar':
+        # Ranked fuzzy matching; `%` is pg_trgm's similarity operator.
+        for column, value in text_filters:
+            query = query.filter(folded(column).op('%')(value))
+        if text_filters:
+            rank = sum(func.similarity(folded(column), value)
+                       for column, value in text_filters)
+            query = query.order_by(rank.desc())
+        query = query.order_by(InventoryItem.id).offset(item_filter.offset)
+    else:
+        for column, value in text_filters:
+            query = query.filter(
+                folded(column).like(f'%{escape_like(value)}%', escape='\\'))
+        query = query.order_by(InventoryItem.id)
+        if item_filter.cursor:
+            query = query.where(
+                InventoryItem.id > decode_cursor(item_filter.cursor, int))
+        else:
+            query = query.offset(item_filter.offset)
+
+    result = await session.scalars(query.limit(item_filter.limit))
     items = result.all()
+    next_cursor = None
+    if item_filter.match != 'similar' and items and len(items) == item_filter.limit:
+        next_cursor = encode_cursor(items[-1].id)
 
-    return {'items': items}
+    return {'items': items, 'next_cursor': next_cursor}
 
 
 @router.patch('/{item_id}', response_model=ItemPublic)
@@ -97,7 +193,14 @@ async def patch_item(
         if key == 'unit':
             value = value.value
         setattr(db_item, key, value)
-    await session.commit()
+    try:
+        await session.execute(bump_inventory_version(user.id))
+        await session.commit()
+    except IntegrityError:
+        await session.rollback()
+        raise HTTPException(
+            status_code=HTTPStatus.CONFLICT, detail='Item name already exists.'
+        )
     await session.refresh(db_item)
 
     return db_item
@@ -114,6 +217,7 @@ async def delete_item(item_id: int, session: T_Session, user: CurrentUser):
             status_code=HTTPStatus.NOT_FOUND, detail='Item not found.'
         )
     await session.delete(item)
+    await session.execute(bump_inventory_version(user.id))
     await session.flush()
     await session.commit()
     return {'message': f'Item {item.name} has been deleted successfully.'}
\ No newline at end of file
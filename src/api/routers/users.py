@@ -9,6 +9,7 @@ from sqlalchemy.ext.asyncio import AsyncSession
 
 from src.database.database import get_asession
 from src.database.models import User
+from src.database.user_cache import notify_telegram_user_changed
 from src.api.schemas import (
     FilterPage,
     Message,
@@ -16,9 +17,12 @@ from src.api.schemas import (
     UserPublic,
     UserSchema,
 )
+from src.api.pagination import decode_cursor, encode_cursor
 from src.api.security import (
     get_current_user,
     get_password_hash,
+    invalidate_principal,
+    verify_password,
 )
 
 router = APIRouter(prefix='/users', tags=['users'])
@@ -41,7 +45,7 @@ async def create_user(user: UserSchema, session: T_Session):
                 detail='Email already exists',
             )
 
-    hashed_password = get_password_hash(user.password)
+    hashed_password = await get_password_hash(user.password)
 
     db_user = User(
         email=user.email,
@@ -49,7 +53,7 @@ async def create_user(user: UserSchema, session: T_Session):
         last_name = user.last_name,
         hashed_password=hashed_password,
         is_active = False,
-        telegram_id = 1111111111
+        telegram_id = None
     )
 
     session.add(db_user)
@@ -61,11 +65,20 @@ async def create_user(user: UserSchema, session: T_Session):
 
 @router.get('/', response_model=UserList)
 async def read_users(session: T_Session, filter_users: Annotated[FilterPage, Query()]):
-    users = await session.scalars(
-        select(User).offset(filter_users.offset).limit(filter_users.limit)
-    ).all()
+    query = select(User).order_by(User.id)
+    if filter_users.cursor:
+        query = query.where(
+            User.id > decode_cursor(filter_users.cursor, UUID))
+    else:
+        query = query.offset(filter_users.offset)
 
-    return {'users': users}
+    result = await session.scalars(query.limit(filter_users.limit))
+    users = result.all()
+    next_cursor = None
+    if users and len(users) == filter_users.limit:
+        next_cursor = encode_cursor(users[-1].id)
+
+    return {'users': users, 'next_cursor': next_cursor}
 
 
 @router.put('/{user_id}', response_model=UserPublic)
@@ -82,10 +95,15 @@ async def update_user(
         )
 
     try:
-        current_user.password = get_password_hash(user.password)
+        if not await verify_password(user.password, current_user.hashed_password):
+            current_user.hashed_password = await get_password_hash(user.password)
+            current_user.token_version += 1
         current_user.email = user.email
+        if current_user.telegram_id is not None:
+            await session.execute(notify_telegram_user_changed(current_user.telegram_id))
         await session.commit()
         await session.refresh(current_user)
+        invalidate_principal(current_user.id)
 
         return current_user
 
@@ -107,7 +125,10 @@ async def delete_user(
             status_code=HTTPStatus.FORBIDDEN, detail='Not enough permissions'
         )
 
-    session.delete(current_user)
+    if current_user.telegram_id is not None:
+        await session.execute(notify_telegram_user_changed(current_user.telegram_id))
+    await session.delete(current_user)
     await session.commit()
+    invalidate_principal(current_user.id)
 
-    return {'message': 'User deleted'}
\ No newline at end of file
+    return {'message': 'User deleted', 'status': 'success'}
\ No newline at end of file
@@ -1,5 +1,5 @@
 from pydantic import BaseModel, ConfigDict, EmailStr
-from typing import Optional
+from typing import Literal, Optional
 from src.agentic_system.basemodels import UnitOptions
 from uuid import UUID
 class Message(BaseModel):
@@ -23,6 +23,7 @@ class StripeChecker(BaseModel):
 
 class UserList(BaseModel):
     users: list[UserPublic]
+    next_cursor: str | None = None
 
 class Token(BaseModel):
     access_token: str
@@ -46,6 +47,7 @@ class ItemPublic(ItemSchema):
 
 class ItemList(BaseModel):
     items: list[ItemPublic]
+    next_cursor: str | None = None
 
 class ItemUpdate(BaseModel):
     name: Optional[str] = None
@@ -56,11 +58,30 @@ class ItemUpdate(BaseModel):
     category: Optional[str] = None
 
 
+class ItemBulkPatch(ItemUpdate):
+    id: int
+
+class ItemBulk(BaseModel):
+    create: list[ItemSchema] = []
+    patch: list[ItemBulkPatch] = []
+    delete: list[int] = []
+
+class ItemBulkResult(BaseModel):
+    created: list[ItemPublic]
+    updated: list[ItemPublic]
+    deleted: list[int]
+
+
 class FilterPage(BaseModel):
     offset: int = 0
     limit: int = 100
+    # Keyset pagination: pass the previous page's next_cursor instead of offset.
+    cursor: Optional[str] = None
 
 class FilterItem(FilterPage):
+    # 'contains': case/accent-insensitive substring match, keyset-paginated.
+    # 'similar': trigram similarity match ranked by closeness, offset-paginated.
+    match: Literal['contains', 'similar'] = 'contains'
     name: Optional[str] = None
     quantity: Optional[float] = None
     location: Optional[str] = None
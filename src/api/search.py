@@ -0,0 +1,18 @@
+import unicodedata
+
+from sqlalchemy import func
+
+
+def fold_text(value: str) -> str:
+    """Lower-case and strip accents in Python, mirroring f_unaccent(lower(...)) in SQL."""
+    decomposed = unicodedata.normalize('NFKD', value.lower())
+    return ''.join(c for c in decomposed if not unicodedata.combining(c))
+
+
+def folded(column):
+    # Must match the trigram index expressions in src/database/models.py.
+    return func.f_unaccent(func.lower(column))
+
+
+def escape_like(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
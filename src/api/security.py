@@ -1,5 +1,8 @@
+from dataclasses import dataclass
 from datetime import datetime, timedelta
+from functools import lru_cache
 from http import HTTPStatus
+from uuid import UUID
 from zoneinfo import ZoneInfo
 
 from fastapi import Depends, HTTPException
@@ -9,63 +12,131 @@ from jwt import ExpiredSignatureError, decode, encode, DecodeError
 from sqlalchemy import select
 from sqlalchemy.ext.asyncio import AsyncSession
 
+from src.database.cache import TTLCache
 from src.database.database import get_asession
 from src.database.models import User
-from src.api.schemas import TokenData
-import bcrypt as bc
+from src.database.passwords import hash_password, verify_password as check_password
 
 import os
 from dotenv import load_dotenv
 load_dotenv()
 
+
+@dataclass(frozen=True)
+class AuthSettings:
+    secret_key: str
+    algorithm: str
+    access_token_expire_minutes: int
+
+
+@lru_cache
+def get_auth_settings() -> AuthSettings:
+    return AuthSettings(
+        secret_key=os.getenv("SECRET_KEY"),
+        algorithm=os.getenv("ALGORITHM"),
+        access_token_expire_minutes=int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES")),
+    )
+
+
+@dataclass(frozen=True)
+class Principal:
+    """The authenticated user as far as most endpoints need it."""
+    id: UUID
+    email: str
+    token_version: int
+
+
+# uid -> Principal. Kept short-lived: another API process that changes the
+# user only invalidates its own copy.
+principal_cache = TTLCache(
+    maxsize=int(os.getenv('AUTH_CACHE_SIZE', '10000')),
+    ttl=float(os.getenv('AUTH_CACHE_TTL', '30')),
+)
+
+
+def invalidate_principal(user_id: UUID):
+    principal_cache.pop(str(user_id))
+
+
+def user_claims(user: User) -> dict:
+    return {'sub': user.email, 'uid': str(user.id), 'ver': user.token_version}
+
+
 def create_access_token(data: dict):
+    settings = get_auth_settings()
     to_encode = data.copy()
     expire = datetime.now(tz=ZoneInfo('UTC')) + timedelta(
-        minutes= int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES"))
+        minutes=settings.access_token_expire_minutes
     )
     to_encode.update({'exp': expire})
     encoded_jwt = encode(
-        to_encode, os.getenv("SECRET_KEY"), algorithm=os.getenv("ALGORITHM")
+        to_encode, settings.secret_key, algorithm=settings.algorithm
     )
     return encoded_jwt
 
 
-def get_password_hash(password: str):
-    return bc.hashpw(password.encode(), bc.gensalt()).decode()
+async def get_password_hash(password: str):
+    return await hash_password(password)
 
-def verify_password(plain_password: str, hashed_password: str):
-    return bc.checkpw(plain_password.encode(), hashed_password.encode())
+async def verify_password(plain_password: str, hashed_password: str):
+    return await check_password(plain_password, hashed_password)
 
 oauth2_schema = OAuth2PasswordBearer(tokenUrl='auth/token')
 
-async def get_current_user(
-    session: AsyncSession = Depends(get_asession),
-    token: str = Depends(oauth2_schema),
-):
-    credentials_exception = HTTPException(
-        status_code=HTTPStatus.UNAUTHORIZED,
-        detail='Could not validate credentials',
-        headers={'WWW-Authenticate': 'Bearer'},
-    )
+credentials_exception = HTTPException(
+    status_code=HTTPStatus.UNAUTHORIZED,
+    detail='Could not validate credentials',
+    headers={'WWW-Authenticate': 'Bearer'},
+)
 
+
+def decode_token(token: str) -> dict:
+    settings = get_auth_settings()
     try:
         payload = decode(
-            token, os.getenv("SECRET_KEY"), algorithms=[os.getenv("ALGORITHM")]
+            token, settings.secret_key, algorithms=[settings.algorithm]
         )
-        username: str = payload.get('sub')
-        if not username:
-            raise credentials_exception
-        token_data = TokenData(username=username)
     except DecodeError:
         raise credentials_exception
     except ExpiredSignatureError:
         raise credentials_exception
+    if not payload.get('sub') or not payload.get('uid'):
+        raise credentials_exception
+    try:
+        payload['uid'] = str(UUID(payload['uid']))
+    except ValueError:
+        raise credentials_exception
+    return payload
 
-    user = await session.scalar(
-        select(User).where(User.email == token_data.username)
-    )
 
-    if not user:
+async def get_current_principal(
+    session: AsyncSession = Depends(get_asession),
+    token: str = Depends(oauth2_schema),
+) -> Principal:
+    payload = decode_token(token)
+    principal = principal_cache.get(payload['uid'])
+    if principal is None:
+        row = (await session.execute(
+            select(User.id, User.email, User.token_version).where(User.id == UUID(payload['uid']))
+        )).first()
+        if not row:
+            raise credentials_exception
+        principal = Principal(id=row.id, email=row.email, token_version=row.token_version)
+        principal_cache.set(payload['uid'], principal)
+
+    if principal.token_version != payload.get('ver'):
+        raise credentials_exception
+    return principal
+
+
+async def get_current_user(
+    session: AsyncSession = Depends(get_asession),
+    token: str = Depends(oauth2_schema),
+):
+    payload = decode_token(token)
+    user = await session.get(User, UUID(payload['uid']))
+
+    if not user or user.token_version != payload.get('ver'):
         raise credentials_exception
 
-    return user
\ No newline at end of file
+    return user
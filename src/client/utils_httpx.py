@@ -1,22 +1,87 @@
+import asyncio
+import os
+from collections.abc import AsyncGenerator
 import httpx
 from datetime import datetime, timezone
 import jwt
+from dotenv import load_dotenv
+load_dotenv()
 
-BACKEND_URL = "http://127.0.0.1:8000"
+BACKEND_URL = os.getenv("BACKEND_URL", "http://127.0.0.1:8000")
+
+# One client per event loop: a client's connections belong to the loop that
+# opened them. Each is closed on its own loop, before the loop closes.
+_clients: dict[asyncio.AbstractEventLoop, tuple[httpx.AsyncClient, AsyncGenerator]] = {}
+
+def _http2_enabled() -> bool:
+    if os.getenv("HTTPX_HTTP2", "").lower() not in ("1", "true", "yes", "on"):
+        return False
+    try:
+        import h2  # noqa: F401  (optional dependency: httpx[http2])
+    except ImportError:
+        return False
+    return True
+
+async def _client_lifetime(loop: asyncio.AbstractEventLoop, client: httpx.AsyncClient):
+    # Parked at the yield for the life of the loop; asyncio.run() closes
+    # pending async generators on the loop before closing it, which closes
+    # the client there.
+    try:
+        yield
+    finally:
+        if _clients.get(loop, (None,))[0] is client:
+            del _clients[loop]
+        await client.aclose()
+
+def get_client() -> httpx.AsyncClient:
+    """
+    Shared keep-alive client for the backend, one per event loop.
+    """
+    loop = asyncio.get_running_loop()
+    for stale in [other for other in _clients if other.is_closed()]:
+        del _clients[stale]
+    client = _clients.get(loop, (None,))[0]
+    if client is None or client.is_closed:
+        client = httpx.AsyncClient(
+            base_url=BACKEND_URL,
+            limits=httpx.Limits(
+                max_connections=int(os.getenv("HTTPX_MAX_CONNECTIONS", "20")),
+                max_keepalive_connections=int(os.getenv("HTTPX_MAX_KEEPALIVE", "10")),
+                keepalive_expiry=float(os.getenv("HTTPX_KEEPALIVE_EXPIRY", "30")),
+            ),
+            timeout=httpx.Timeout(
+                float(os.getenv("HTTPX_TIMEOUT", "10")),
+                connect=float(os.getenv("HTTPX_CONNECT_TIMEOUT", "5")),
+            ),
+            http2=_http2_enabled(),
+        )
+        lifetime = _client_lifetime(loop, client)
+        loop.create_task(anext(lifetime))
+        _clients[loop] = (client, lifetime)
+    return client
+
+async def aclose_client():
+    """
+    Close the current loop's client; the next get_client() opens a new one.
+    """
+    entry = _clients.pop(asyncio.get_running_loop(), None)
+    if entry is not None:
+        client, lifetime = entry
+        await lifetime.aclose()
+        await client.aclose()
 
 async def login(username: str, password: str):
     """
     Send a POST request to the FastAPI backend to authenticate the user.
     """
-    url = f"{BACKEND_URL}/auth/token"
+    url = "/auth/token"
     data = {
         "username": username, 
         "password": password
         }
     headers = {"Content-Type": "application/x-www-form-urlencoded"}
     
-    async with httpx.AsyncClient() as client:
-        response = await client.post(url, data=data, headers=headers)
+    response = await get_client().post(url, data=data, headers=headers)
     
     if response.status_code == 200:
         return response.json()
@@ -32,11 +97,10 @@ async def add_item(token: str, item_data: dict):
     """
     Send a POST request to the FastAPI backend to add a new item.
     """
-    url = f"{BACKEND_URL}/items/"
+    url = "/items/"
     headers = {"Authorization": f"Bearer {token}", "Content-Type": "application/json"}
     
-    async with httpx.AsyncClient() as client:
-        response = await client.post(url, json=item_data, headers=headers)
+    response = await get_client().post(url, json=item_data, headers=headers)
     
     if response.status_code == 200:
         return response.json()
@@ -44,11 +108,10 @@ async def add_item(token: str, item_data: dict):
         return f"Failed to add item: {response.text}"
 
 async def get_items(token: str):
-    url = f"{BACKEND_URL}/items/"
+    url = "/items/"
     headers = {"Authorization": f"Bearer {token}", "Content-Type": "application/json"}
     
-    async with httpx.AsyncClient() as client:
-        response = await client.get(url, headers=headers)
+    response = await get_client().get(url, headers=headers)
     
     if response.status_code == 200:
         return response.json()
@@ -59,11 +122,10 @@ async def patch_item_request(token: str, item_id: int, item_data: dict):
     """
     Send a PATCH request to update an item in the inventory.
     """
-    url = f"{BACKEND_URL}/items/{item_id}"
+    url = f"/items/{item_id}"
     headers = {"Authorization": f"Bearer {token}", "Content-Type": "application/json"}
     
-    async with httpx.AsyncClient() as client:
-        response = await client.patch(url, json=item_data, headers=headers)
+    response = await get_client().patch(url, json=item_data, headers=headers)
     
     if response.status_code == 200:
         return response.json()
@@ -71,17 +133,30 @@ async def patch_item_request(token: str, item_id: int, item_data: dict):
         return {"error": f"Failed to update item: {response.text}"}
 
 async def delete_item_request(token: str, item_id: int):
-    url = f"{BACKEND_URL}/items/{item_id}"
+    url = f"/items/{item_id}"
     headers = {"Authorization": f"Bearer {token}", "Content-Type": "application/json"}
     
-    async with httpx.AsyncClient() as client:
-        response = await client.delete(url, headers=headers)
+    response = await get_client().delete(url, headers=headers)
     
     if response.status_code == 200:
         return response.json()
     else:
         return {"error": f"Failed to delete item: {response.text}"}
 
+async def bulk_items_request(token: str, payload: dict):
+    """
+    Send creates, patches and deletes to the backend in a single request.
+    """
+    url = "/items/bulk"
+    headers = {"Authorization": f"Bearer {token}", "Content-Type": "application/json"}
+    
+    response = await get_client().post(url, json=payload, headers=headers)
+    
+    if response.status_code == 200:
+        return response.json()
+    else:
+        return {"error": f"Failed to apply changes: {response.text}"}
+
 column_map = {
     'quantity': 'quantidade',
     'name': 'nome',
@@ -93,30 +168,98 @@ column_map = {
 }
 reverse_column_map = {v: k for k, v in column_map.items()}
 
-async def update_database(token: str, **kwargs):
+BULK_CHUNK_SIZE = int(os.getenv("BULK_CHUNK_SIZE", "500"))
+BULK_CONCURRENCY = int(os.getenv("BULK_CONCURRENCY", "4"))
+
+def _bulk_chunks(creates: list, patches: dict, deletes: list, chunk_size: int):
+    """
+    Split the edits into bulk payloads of about chunk_size operations.
+    Every operation on one item id lands in the same payload, where the
+    backend applies patches before deletes.
+    """
+    units, delete_ids = [], set(deletes)
+    for item_id in dict.fromkeys([*patches, *deletes]):
+        unit = {"create": [], "patch": [], "delete": []}
+        if item_id in patches:
+            unit["patch"].append(patches[item_id])
+        if item_id in delete_ids:
+            unit["delete"].append(item_id)
+        units.append(unit)
+    units.extend({"create": [item], "patch": [], "delete": []} for item in creates)
+
+    chunks, current, size = [], {"create": [], "patch": [], "delete": []}, 0
+    for unit in units:
+        for key in current:
+            current[key].extend(unit[key])
+        size += len(unit["patch"]) + len(unit["delete"]) + len(unit["create"])
+        if size >= chunk_size:
+            chunks.append(current)
+            current, size = {"create": [], "patch": [], "delete": []}, 0
+    if size:
+        chunks.append(current)
+    return chunks
+
+async def update_database(token: str, max_concurrency: int | None = None,
+                          chunk_size: int | None = None, **kwargs):
+    """
+    Apply dashboard edits through POST /items/bulk, sending chunks concurrently.
+    Returns one result per operation, in input order: the changed cells, then
+    the new items, then the deleted ids.
+    """
     new_items = kwargs.get("new_items", [])
     del_items = kwargs.get("del_items", [])
     change_map = kwargs.get("change_map", {})
 
-    resp = []
-
+    cell_ids = []
+    patches = {}
     if change_map:
         for i in range(len(change_map['id'])):
-            item_id = change_map['id'][i]
+            item_id = int(change_map['id'][i])
             column = change_map['column'][i]
             column = reverse_column_map.get(column, column)
             value = change_map['value'][i]
             
-            resp.append(await patch_item_request(token=token, item_id=item_id, item_data={column: value}))
+            cell_ids.append(item_id)
+            patches.setdefault(item_id, {"id": item_id})[column] = value
     
-    if new_items:
-        for item_data in new_items:
-            item_data.pop("index", None)
-            item_data.pop("deletar item?", None)
-            resp.append(await add_item(token=token, item_data=item_data))
+    creates = []
+    for item_data in new_items:
+        item_data.pop("index", None)
+        item_data.pop("deletar item?", None)
+        creates.append(item_data)
     
-    if del_items:
-        for item_id in del_items:
-            resp.append(await delete_item_request(token=token, item_id=item_id))
-    
-    return resp
\ No newline at end of file
+    deletes = [int(item_id) for item_id in del_items]
+
+    chunks = _bulk_chunks(creates, patches, deletes, chunk_size or BULK_CHUNK_SIZE)
+    semaphore = asyncio.Semaphore(max_concurrency or BULK_CONCURRENCY)
+
+    async def send(payload: dict):
+        async with semaphore:
+            try:
+                return await bulk_items_request(token=token, payload=payload)
+            except httpx.HTTPError as e:
+                return {"error": f"Failed to apply changes: {e!r}"}
+
+    responses = await asyncio.gather(*(send(chunk) for chunk in chunks))
+
+    updated, created, deleted = {}, {}, {}
+    for chunk, response in zip(chunks, responses):
+        if "error" in response:
+            for patch in chunk["patch"]:
+                updated[patch["id"]] = response
+            for item in chunk["create"]:
+                created[id(item)] = response
+            for item_id in chunk["delete"]:
+                deleted[item_id] = response
+            continue
+        for item in response["updated"]:
+            updated[item["id"]] = item
+        for item, result in zip(chunk["create"], response["created"]):
+            created[id(item)] = result
+        for item_id in response["deleted"]:
+            deleted[item_id] = {"id": item_id, "deleted": True}
+
+    resp = [updated.get(item_id) or deleted[item_id] for item_id in cell_ids]
+    resp += [created[id(item)] for item in creates]
+    resp += [deleted[item_id] for item_id in deletes]
+    return resp
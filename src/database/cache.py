@@ -0,0 +1,98 @@
+import sys
+import time
+from collections import OrderedDict
+from typing import Any, Hashable
+
+
+class TTLCache:
+    """Bounded in-process LRU mapping whose entries expire `ttl` seconds after being set."""
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 60.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        entry = self._data.get(key)
+        if entry is None:
+            return default
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self._data[key]
+            return default
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key: Hashable, value: Any):
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def incr(self, key: Hashable, delta: Any):
+        """Add `delta` to a live entry without extending its lifetime; no-op when absent."""
+        entry = self._data.get(key)
+        if entry is not None and entry[0] >= time.monotonic():
+            self._data[key] = (entry[0], entry[1] + delta)
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        entry = self._data.pop(key, None)
+        return default if entry is None else entry[1]
+
+    def clear(self):
+        self._data.clear()
+
+    def __contains__(self, key: Hashable) -> bool:
+        return self.get(key, _MISSING) is not _MISSING
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+_MISSING = object()
+
+
+class SizedLRUCache:
+    """In-process LRU mapping bounded by the approximate memory of its entries."""
+
+    def __init__(self, max_bytes: int = 16 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._data: OrderedDict[Hashable, tuple[int, Any]] = OrderedDict()
+
+    @staticmethod
+    def _sizeof(key: Hashable, value: Any) -> int:
+        parts = (*key, value) if isinstance(key, tuple) else (key, value)
+        return sum(sys.getsizeof(part) for part in parts)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        entry = self._data.get(key)
+        if entry is None:
+            return default
+        self._data.move_to_end(key)
+        return entry[1]
+
+    def set(self, key: Hashable, value: Any):
+        self.pop(key)
+        nbytes = self._sizeof(key, value)
+        if nbytes > self.max_bytes:
+            return
+        self._data[key] = (nbytes, value)
+        self.size += nbytes
+        while self.size > self.max_bytes:
+            _, (evicted, _) = self._data.popitem(last=False)
+            self.size -= evicted
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        entry = self._data.pop(key, None)
+        if entry is None:
+            return default
+        self.size -= entry[0]
+        return entry[1]
+
+    def clear(self):
+        self._data.clear()
+        self.size = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
@@ -1,21 +1,17 @@
 from contextlib import asynccontextmanager
-from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from src.database.engine import get_sessionmaker, dispose_engine
 from src.database.models import User
-import bcrypt as bc
+from src.database.passwords import hash_password
 import asyncio
 from dotenv import load_dotenv
 import os
 load_dotenv()
 
-url = os.getenv("DATABASE_URL")
 telegram_id = os.getenv("MY_USER_ID")
 
-engine = create_async_engine(url=url)
-asyncsession = async_sessionmaker(engine, expire_on_commit=False)
-
 @asynccontextmanager
 async def get_async_session():
-    async_session = asyncsession()
+    async_session = get_sessionmaker()()
     try:
         yield async_session
         await async_session.commit()
@@ -26,17 +22,17 @@ async def get_async_session():
         await async_session.close()
 
 async def get_asession():
-    instance_session = asyncsession()
+    instance_session = get_sessionmaker()()
     async with instance_session as session:
         yield session
 
 async def create_user(first_name, last_name, email, password, telegram_id):
-    hashed_password = bc.hashpw(password.encode('utf-8'), bc.gensalt())
+    hashed_password = await hash_password(password)
     user = User(
         first_name=first_name,
         last_name=last_name,
         email=email,
-        hashed_password=hashed_password.decode('utf-8'),
+        hashed_password=hashed_password,
         telegram_id = int(telegram_id),
         is_active=True
     )
@@ -59,6 +55,7 @@ async def main():
         password='fuba0603',
         telegram_id=int(1025568783)
     )
+    await dispose_engine()
 
 if __name__ == '__main__':
     # import sys
@@ -0,0 +1,81 @@
+from dataclasses import dataclass
+from functools import lru_cache
+from uuid import uuid4
+import os
+
+from sqlalchemy.ext.asyncio import (AsyncEngine, async_sessionmaker,
+                                    create_async_engine)
+from dotenv import load_dotenv
+load_dotenv()
+
+
+def _env_bool(name: str, default: bool) -> bool:
+    value = os.getenv(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ('1', 'true', 'yes', 'on')
+
+
+@dataclass(frozen=True)
+class EngineSettings:
+    url: str
+    pool_size: int
+    max_overflow: int
+    pool_pre_ping: bool
+    pool_recycle: int
+    statement_cache_size: int
+    pgbouncer: bool
+
+
+@lru_cache
+def get_engine_settings() -> EngineSettings:
+    return EngineSettings(
+        url=os.getenv('DATABASE_URL'),
+        pool_size=int(os.getenv('DB_POOL_SIZE', '5')),
+        max_overflow=int(os.getenv('DB_MAX_OVERFLOW', '10')),
+        pool_pre_ping=_env_bool('DB_POOL_PRE_PING', True),
+        pool_recycle=int(os.getenv('DB_POOL_RECYCLE', '1800')),
+        statement_cache_size=int(os.getenv('DB_STATEMENT_CACHE_SIZE', '100')),
+        pgbouncer=_env_bool('DB_PGBOUNCER', False),
+    )
+
+
+@lru_cache
+def get_engine() -> AsyncEngine:
+    """The one engine (and connection pool) shared by the bot, the agent and the API."""
+    settings = get_engine_settings()
+    connect_args = {}
+    if settings.url.startswith('postgresql+asyncpg'):
+        if settings.pgbouncer:
+            # PgBouncer in transaction mode cannot keep prepared statements
+            # across transactions, so disable both caches and use unique names.
+            connect_args = {
+                'statement_cache_size': 0,
+                'prepared_statement_cache_size': 0,
+                'prepared_statement_name_func': lambda: f'__asyncpg_{uuid4()}__',
+            }
+        else:
+            connect_args = {
+                'prepared_statement_cache_size': settings.statement_cache_size,
+            }
+    return create_async_engine(
+        settings.url,
+        pool_size=settings.pool_size,
+        max_overflow=settings.max_overflow,
+        pool_pre_ping=settings.pool_pre_ping,
+        pool_recycle=settings.pool_recycle,
+        connect_args=connect_args,
+    )
+
+
+@lru_cache
+def get_sessionmaker() -> async_sessionmaker:
+    return async_sessionmaker(get_engine(), expire_on_commit=False)
+
+
+async def dispose_engine():
+    """Close every pooled connection; the next get_engine() call builds a fresh engine."""
+    if get_engine.cache_info().currsize:
+        await get_engine().dispose()
+    get_sessionmaker.cache_clear()
+    get_engine.cache_clear()
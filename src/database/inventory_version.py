@@ -0,0 +1,24 @@
+from typing import Union
+from uuid import UUID
+
+from sqlalchemy import select
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from src.database.models import InventoryVersion
+
+
+def bump_inventory_version(user_id: Union[str, UUID]):
+    """Statement that increments the user's inventory version; run it in the writing transaction."""
+    stmt = insert(InventoryVersion).values(user_id=user_id, version=1)
+    return stmt.on_conflict_do_update(
+        index_elements=[InventoryVersion.user_id],
+        set_={'version': InventoryVersion.version + 1},
+    )
+
+
+async def get_inventory_version(session: AsyncSession, user_id: Union[str, UUID]) -> int:
+    version = await session.scalar(
+        select(InventoryVersion.version).where(InventoryVersion.user_id == user_id)
+    )
+    return version or 0
@@ -2,7 +2,8 @@ import uuid
 from datetime import datetime
 from sqlalchemy.orm import registry, mapped_column, Mapped, relationship
 from sqlalchemy import (ForeignKey, func, String, BigInteger, 
-                        DateTime, Numeric, Boolean)
+                        DateTime, Numeric, Boolean, Index, SmallInteger,
+                        DDL, event, Integer, LargeBinary, JSON)
 from sqlalchemy.dialects.postgresql import UUID
 
 table_registry = registry()
@@ -23,6 +24,8 @@ class User:
     telegram_id: Mapped[int] = mapped_column(BigInteger, nullable=True)
     is_active: Mapped[bool] = mapped_column(Boolean, nullable=False)
     hashed_password: Mapped[str] = mapped_column(String(128), nullable=False)
+    # Bumped to revoke every access token issued before (password change).
+    token_version: Mapped[int] = mapped_column(Integer, nullable=False, default=0, server_default='0')
     created_at: Mapped[datetime] = mapped_column(
         DateTime, 
         init=False, 
@@ -36,6 +39,11 @@ class User:
         onupdate=func.now(),
         nullable=False
     )
+
+    # One account per Telegram chat; also serves the bot's per-message lookup.
+    __table_args__ = (
+        Index('uq_users_telegram_id', 'telegram_id', unique=True),
+    )
     
     # relationship
     inventory_items: Mapped[list['InventoryItem']] = relationship(
@@ -47,7 +55,8 @@ class User:
     meta_logs: Mapped[list['MetaLog']] = relationship(
     init=False,
     back_populates='user',
-    lazy='dynamic' 
+    lazy='dynamic',
+    passive_deletes=True,
 )
 
 @table_registry.mapped_as_dataclass
@@ -55,7 +64,7 @@ class MetaLog:
     __tablename__ = 'meta_logs'
 
     id: Mapped[int] = mapped_column(init=False, primary_key=True, autoincrement=True)
-    user_id: Mapped[uuid.UUID] = mapped_column(ForeignKey('users.id'),nullable=False, index=True)
+    user_id: Mapped[uuid.UUID] = mapped_column(ForeignKey('users.id', ondelete='CASCADE'),nullable=False, index=True)
     n_tokens: Mapped[int] = mapped_column(BigInteger, nullable=True)
     created_at: Mapped[datetime] = mapped_column(
         DateTime,
@@ -70,6 +79,89 @@ class MetaLog:
     )
 
 
+# Running token total per user and calendar month, kept in step with
+# meta_logs by the token usage writer so quota checks are a point lookup.
+@table_registry.mapped_as_dataclass
+class UserMonthlyUsage:
+    __tablename__ = 'user_monthly_usage'
+
+    user_id: Mapped[uuid.UUID] = mapped_column(ForeignKey('users.id', ondelete='CASCADE'), primary_key=True)
+    year: Mapped[int] = mapped_column(SmallInteger, primary_key=True)
+    month: Mapped[int] = mapped_column(SmallInteger, primary_key=True)
+    n_tokens: Mapped[int] = mapped_column(BigInteger, nullable=False, default=0)
+
+
+# Bumped by every write to a user's inventory; cached answers to inventory
+# questions are keyed by it so they expire as soon as the data changes.
+@table_registry.mapped_as_dataclass
+class InventoryVersion:
+    __tablename__ = 'inventory_versions'
+
+    user_id: Mapped[uuid.UUID] = mapped_column(ForeignKey('users.id', ondelete='CASCADE'), primary_key=True)
+    version: Mapped[int] = mapped_column(BigInteger, nullable=False, default=0)
+
+
+# Durable LangGraph checkpoints (CHECKPOINT_BACKEND=postgres). Only the
+# latest few checkpoints per conversation are kept, each stored whole and
+# serialized by the graph's serializer.
+@table_registry.mapped_as_dataclass
+class GraphCheckpoint:
+    __tablename__ = 'graph_checkpoints'
+
+    thread_id: Mapped[str] = mapped_column(String(100), primary_key=True)
+    checkpoint_ns: Mapped[str] = mapped_column(String(255), primary_key=True)
+    checkpoint_id: Mapped[str] = mapped_column(String(64), primary_key=True)
+    parent_checkpoint_id: Mapped[str] = mapped_column(String(64), nullable=True)
+    type: Mapped[str] = mapped_column(String(50), nullable=False)
+    checkpoint: Mapped[bytes] = mapped_column(LargeBinary, nullable=False)
+    metadata_type: Mapped[str] = mapped_column(String(50), nullable=False)
+    checkpoint_metadata: Mapped[bytes] = mapped_column(LargeBinary, nullable=False)
+    updated_at: Mapped[datetime] = mapped_column(
+        DateTime,
+        init=False,
+        server_default=func.now(),
+        onupdate=func.now(),
+        nullable=False
+    )
+
+    __table_args__ = (
+        Index('ix_graph_checkpoints_updated_at', 'updated_at'),
+    )
+
+
+@table_registry.mapped_as_dataclass
+class GraphCheckpointWrite:
+    __tablename__ = 'graph_checkpoint_writes'
+
+    thread_id: Mapped[str] = mapped_column(String(100), primary_key=True)
+    checkpoint_ns: Mapped[str] = mapped_column(String(255), primary_key=True)
+    checkpoint_id: Mapped[str] = mapped_column(String(64), primary_key=True)
+    task_id: Mapped[str] = mapped_column(String(64), primary_key=True)
+    idx: Mapped[int] = mapped_column(Integer, primary_key=True)
+    channel: Mapped[str] = mapped_column(String(255), nullable=False)
+    type: Mapped[str] = mapped_column(String(50), nullable=False)
+    value: Mapped[bytes] = mapped_column(LargeBinary, nullable=False)
+    task_path: Mapped[str] = mapped_column(String(255), nullable=False, default='')
+
+
+# aiogram FSM state per storage key (FSM_STORAGE=sql), shared by every bot
+# worker process so a user's login flow survives restarts and resharding.
+@table_registry.mapped_as_dataclass
+class BotFSMState:
+    __tablename__ = 'bot_fsm_states'
+
+    key: Mapped[str] = mapped_column(String(255), primary_key=True)
+    state: Mapped[str] = mapped_column(String(255), nullable=True)
+    data: Mapped[dict] = mapped_column(JSON, nullable=False)
+    updated_at: Mapped[datetime] = mapped_column(
+        DateTime,
+        init=False,
+        server_default=func.now(),
+        onupdate=func.now(),
+        nullable=False
+    )
+
+
 @table_registry.mapped_as_dataclass
 class InventoryItem:
     __tablename__ = 'inventory_items'
@@ -101,6 +193,54 @@ class InventoryItem:
     )
     user: Mapped[User] = relationship(init=False, back_populates="inventory_items")
 
+# One row per item name and user, regardless of case. Backs the
+# INSERT ... ON CONFLICT upsert used by the agent "add" updates.
+Index(
+    'uq_inventory_items_user_id_lower_name',
+    InventoryItem.user_id,
+    func.lower(InventoryItem.name),
+    unique=True,
+)
+
+# Keyset pagination of a user's items (GET /items ordered by id).
+Index(
+    'ix_inventory_items_user_id_id',
+    InventoryItem.user_id,
+    InventoryItem.id,
+)
+
+# Case- and accent-insensitive substring and similarity search on the text
+# columns of GET /items. unaccent() is only STABLE, so it is wrapped in an
+# IMMUTABLE function that index expressions are allowed to use.
+for statement in (
+    'CREATE EXTENSION IF NOT EXISTS pg_trgm',
+    'CREATE EXTENSION IF NOT EXISTS unaccent',
+    "CREATE OR REPLACE FUNCTION f_unaccent(text) RETURNS text AS "
+    "$$ SELECT public.unaccent('public.unaccent', $1) $$ "
+    "LANGUAGE sql IMMUTABLE PARALLEL SAFE STRICT",
+):
+    event.listen(table_registry.metadata, 'before_create', DDL(statement))
+
+for column in ('name', 'location', 'description', 'category'):
+    Index(
+        f'ix_inventory_items_{column}_trgm',
+        func.f_unaccent(func.lower(getattr(InventoryItem, column))).label(f'{column}_folded'),
+        postgresql_using='gin',
+        postgresql_ops={f'{column}_folded': 'gin_trgm_ops'},
+    )
+
+# Role the agent's generated SQL runs as (sql_guard.SQL_QUERY_ROLE): it can
+# read inventory_items and nothing else. The app's role is made a member so
+# it can SET ROLE to it.
+for statement in (
+    "DO $$ BEGIN "
+    "IF NOT EXISTS (SELECT FROM pg_roles WHERE rolname = 'inventory_reader') "
+    "THEN CREATE ROLE inventory_reader NOLOGIN; END IF; END $$",
+    'GRANT SELECT ON inventory_items TO inventory_reader',
+    'GRANT inventory_reader TO CURRENT_USER',
+):
+    event.listen(InventoryItem.__table__, 'after_create', DDL(statement))
+
 
 if __name__ == '__main__':
     from dotenv import load_dotenv
@@ -0,0 +1,37 @@
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+import bcrypt as bc
+from dotenv import load_dotenv
+load_dotenv()
+
+# bcrypt releases the GIL, so a small thread pool keeps hashing off the
+# event loop; its size is the number of hashes computed at once, the rest
+# wait their turn without blocking other requests.
+BCRYPT_ROUNDS = int(os.getenv('BCRYPT_ROUNDS', '12'))
+PASSWORD_HASH_WORKERS = int(os.getenv('PASSWORD_HASH_WORKERS', '2'))
+
+
+@lru_cache
+def get_password_executor() -> ThreadPoolExecutor:
+    return ThreadPoolExecutor(max_workers=PASSWORD_HASH_WORKERS, thread_name_prefix='bcrypt')
+
+
+def _hash(password: str, rounds: int) -> str:
+    return bc.hashpw(password.encode(), bc.gensalt(rounds=rounds)).decode()
+
+
+def _verify(password: str, hashed_password: str) -> bool:
+    return bc.checkpw(password.encode(), hashed_password.encode())
+
+
+async def hash_password(password: str, rounds: int = BCRYPT_ROUNDS) -> str:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_password_executor(), _hash, password, rounds)
+
+
+async def verify_password(password: str, hashed_password: str) -> bool:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_password_executor(), _verify, password, hashed_password)
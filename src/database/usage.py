@@ -0,0 +1,218 @@
+import asyncio
+import logging
+import os
+from collections import defaultdict
+from typing import Union
+from uuid import UUID
+
+from sqlalchemy import insert, select, func, cast, SmallInteger
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.exc import DataError, IntegrityError
+
+from src.database.cache import TTLCache
+from src.database.engine import get_sessionmaker, dispose_engine
+from src.database.models import MetaLog, UserMonthlyUsage
+from dotenv import load_dotenv
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Keyed by user only: at the turn of the month the previous month's total
+# is served until the entry expires.
+monthly_usage_cache = TTLCache(
+    maxsize=int(os.getenv('USAGE_CACHE_SIZE', '10000')),
+    ttl=float(os.getenv('USAGE_CACHE_TTL', '60')),
+)
+
+
+# The month is always taken from the database's clock, as meta_logs.created_at
+# is: the live counter and backfill_monthly_usage then agree on which month
+# every row belongs to, whatever the app servers' clocks and time zones.
+def _year(timestamp):
+    return cast(func.extract('year', timestamp), SmallInteger)
+
+
+def _month(timestamp):
+    return cast(func.extract('month', timestamp), SmallInteger)
+
+
+def _upsert_monthly_usage(rows: list[dict]):
+    stmt = pg_insert(UserMonthlyUsage).values(rows)
+    return stmt.on_conflict_do_update(
+        index_elements=[UserMonthlyUsage.user_id, UserMonthlyUsage.year, UserMonthlyUsage.month],
+        set_={'n_tokens': UserMonthlyUsage.n_tokens + stmt.excluded.n_tokens},
+    )
+
+
+async def get_monthly_tokens(user_id: Union[str, UUID]) -> int:
+    """Tokens used by the user in the database's current month, served from a short-lived cache."""
+    key = str(user_id)
+    total = monthly_usage_cache.get(key)
+    if total is None:
+        async with get_sessionmaker()() as session:
+            total = await session.scalar(
+                select(UserMonthlyUsage.n_tokens).where(
+                    UserMonthlyUsage.user_id == user_id,
+                    UserMonthlyUsage.year == _year(func.localtimestamp()),
+                    UserMonthlyUsage.month == _month(func.localtimestamp()),
+                )
+            ) or 0
+        monthly_usage_cache.set(key, total)
+    return total
+
+
+class TokenUsageWriter:
+    """Buffers token usage events and writes them to meta_logs in bulk.
+
+    record() only appends to an in-memory buffer. A background task flushes
+    the buffer with one multi-row INSERT once it holds `batch_size` events
+    or every `flush_interval` seconds, whichever comes first. The same
+    transaction adds the totals to user_monthly_usage.
+
+    A batch the database rejects (e.g. a row for a deleted user) is retried
+    row by row and the failing rows are dropped. Other failures (the
+    database is down) keep the rows for `max_attempts` flushes, backing off
+    up to `max_backoff` seconds; the buffer never holds more than
+    `max_buffer` rows, the oldest are dropped first. Dropped rows are
+    logged at ERROR level with their contents.
+    """
+
+    def __init__(self, batch_size: int | None = None, flush_interval: float | None = None,
+                 max_buffer: int | None = None, max_attempts: int | None = None,
+                 max_backoff: float | None = None):
+        self.batch_size = batch_size or int(os.getenv('TOKEN_USAGE_BATCH_SIZE', '100'))
+        self.flush_interval = flush_interval or float(os.getenv('TOKEN_USAGE_FLUSH_INTERVAL', '1.0'))
+        self.max_buffer = max_buffer or int(os.getenv('TOKEN_USAGE_MAX_BUFFER', '10000'))
+        self.max_attempts = max_attempts or int(os.getenv('TOKEN_USAGE_MAX_ATTEMPTS', '8'))
+        self.max_backoff = max_backoff or float(os.getenv('TOKEN_USAGE_MAX_BACKOFF', '60'))
+        self._buffer: list[dict] = []
+        self._wakeup: asyncio.Event | None = None
+        self._task: asyncio.Task | None = None
+        self._closing = False
+        self._failures = 0
+        self.dropped = 0
+
+    def record(self, user_id: Union[str, UUID], n_tokens: int):
+        self._buffer.append({'user_id': user_id, 'n_tokens': n_tokens, 'attempts': 0})
+        self._trim()
+        monthly_usage_cache.incr(str(user_id), n_tokens or 0)
+        if self._task is None or self._task.done():
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.get_running_loop().create_task(self._run())
+        if len(self._buffer) >= self.batch_size:
+            self._wakeup.set()
+
+    def _drop(self, rows: list[dict], reason: str):
+        self.dropped += len(rows)
+        logger.error('Dropping %d token usage rows (%s): %s', len(rows), reason,
+                     [(str(row['user_id']), row['n_tokens']) for row in rows])
+
+    def _trim(self):
+        overflow = len(self._buffer) - self.max_buffer
+        if overflow > 0:
+            self._drop(self._buffer[:overflow], 'buffer full')
+            del self._buffer[:overflow]
+
+    async def _run(self):
+        while not self._closing:
+            timeout = min(self.flush_interval * 2 ** self._failures, self.max_backoff)
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    @staticmethod
+    async def _write(rows: list[dict]):
+        monthly = defaultdict(int)
+        for row in rows:
+            monthly[UUID(str(row['user_id']))] += row['n_tokens'] or 0
+        # localtimestamp is the transaction's start, the same instant the
+        # meta_logs rows get as created_at.
+        year, month = _year(func.localtimestamp()), _month(func.localtimestamp())
+        async with get_sessionmaker()() as session:
+            await session.execute(insert(MetaLog).values(
+                [{'user_id': row['user_id'], 'n_tokens': row['n_tokens']} for row in rows]))
+            await session.execute(_upsert_monthly_usage(
+                [{'user_id': user_id, 'year': year, 'month': month, 'n_tokens': n_tokens}
+                 for user_id, n_tokens in monthly.items()]))
+            await session.commit()
+
+    def _retry(self, rows: list[dict]):
+        """Put `rows` back at the front of the buffer, dropping the ones out of attempts."""
+        self._failures = min(self._failures + 1, 16)
+        for row in rows:
+            row['attempts'] += 1
+        expired = [row for row in rows if row['attempts'] >= self.max_attempts]
+        if expired:
+            self._drop(expired, f'failed {self.max_attempts} times')
+        self._buffer[:0] = [row for row in rows if row['attempts'] < self.max_attempts]
+        self._trim()
+
+    async def flush(self):
+        if not self._buffer:
+            return
+        rows, self._buffer = self._buffer, []
+        try:
+            await self._write(rows)
+        except (IntegrityError, DataError):
+            # One bad row (e.g. for a deleted user) fails the whole batch;
+            # write them one by one so only that row is lost.
+            logger.warning('Token usage batch of %d rows rejected; writing them one by one', len(rows))
+            for index, row in enumerate(rows):
+                try:
+                    await self._write([row])
+                except (IntegrityError, DataError) as e:
+                    self._drop([row], f'rejected: {e.orig}')
+                except Exception:
+                    logger.exception('Failed to write token usage rows, keeping them for retry')
+                    self._retry(rows[index:])
+                    return
+        except Exception:
+            logger.exception('Failed to write %d token usage rows, keeping them for retry', len(rows))
+            self._retry(rows)
+            return
+        self._failures = 0
+
+    async def aclose(self):
+        """Stop the background task and write whatever is still buffered."""
+        self._closing = True
+        if self._task is not None:
+            self._wakeup.set()
+            await self._task
+            self._task = None
+        await self.flush()
+        self._closing = False
+
+
+token_usage_writer = TokenUsageWriter()
+
+
+async def backfill_monthly_usage():
+    """Rebuild user_monthly_usage from the full meta_logs history."""
+    year, month = _year(MetaLog.created_at), _month(MetaLog.created_at)
+    totals = (
+        select(MetaLog.user_id, year, month, func.coalesce(func.sum(MetaLog.n_tokens), 0))
+        .group_by(MetaLog.user_id, year, month)
+    )
+    stmt = pg_insert(UserMonthlyUsage).from_select(
+        ['user_id', 'year', 'month', 'n_tokens'], totals)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[UserMonthlyUsage.user_id, UserMonthlyUsage.year, UserMonthlyUsage.month],
+        set_={'n_tokens': stmt.excluded.n_tokens},
+    )
+    async with get_sessionmaker()() as session:
+        result = await session.execute(stmt)
+        await session.commit()
+    monthly_usage_cache.clear()
+    return result.rowcount
+
+
+async def main():
+    rows = await backfill_monthly_usage()
+    await dispose_engine()
+    print(f'user_monthly_usage backfilled: {rows} rows.')
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,102 @@
+import asyncio
+import logging
+import os
+from dataclasses import dataclass
+from uuid import UUID
+
+from sqlalchemy import func, select, update
+
+from src.database.cache import TTLCache
+from src.database.engine import get_engine, get_sessionmaker
+from src.database.models import User
+from dotenv import load_dotenv
+load_dotenv()
+
+# Serves the bot's per-message user lookup. The bot invalidates entries on
+# /start and login; the API reports its changes on USER_CHANGES_CHANNEL,
+# which listen_telegram_user_changes turns into invalidations. The TTL only
+# bounds staleness while that listener is disconnected.
+telegram_user_cache = TTLCache(
+    maxsize=int(os.getenv('USER_CACHE_SIZE', '10000')),
+    ttl=float(os.getenv('USER_CACHE_TTL', '300')),
+)
+USER_CHANGES_CHANNEL = 'telegram_user_changed'
+USER_CHANGES_PING_INTERVAL = float(os.getenv('USER_CHANGES_PING_INTERVAL', '30'))
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class TelegramUser:
+    id: UUID
+    name: str
+    is_active: bool
+
+
+async def get_telegram_user(telegram_id: int) -> TelegramUser | None:
+    """The user linked to `telegram_id`, or None. Only found users are cached."""
+    user = telegram_user_cache.get(telegram_id)
+    if user is None:
+        async with get_sessionmaker()() as session:
+            row = (await session.execute(
+                select(User.id, User.first_name, User.last_name, User.is_active)
+                .where(User.telegram_id == telegram_id)
+            )).first()
+        if row is None:
+            return None
+        user = TelegramUser(id=row.id, name=f'{row.first_name} {row.last_name}', is_active=row.is_active)
+        telegram_user_cache.set(telegram_id, user)
+    return user
+
+
+def invalidate_telegram_user(telegram_id: int | None):
+    if telegram_id is not None:
+        telegram_user_cache.pop(int(telegram_id))
+
+
+def notify_telegram_user_changed(telegram_id: int):
+    """Statement that, when its transaction commits, invalidates `telegram_id` in every listening process."""
+    return select(func.pg_notify(USER_CHANGES_CHANNEL, str(telegram_id)))
+
+
+async def listen_telegram_user_changes(interval: float = USER_CHANGES_PING_INTERVAL):
+    """Invalidate the users other processes report changed, until cancelled.
+
+    Keeps one pooled connection LISTENing, pinged every `interval` seconds.
+    Notifications sent while it is down are lost, so the cache is cleared
+    on every (re)connect.
+    """
+    if get_engine().dialect.name != 'postgresql':
+        return
+
+    def on_change(connection, pid, channel, payload):
+        invalidate_telegram_user(int(payload))
+
+    while True:
+        try:
+            async with get_engine().connect() as conn:
+                # Use the driver directly: Postgres holds notifications back
+                # while the listening session is inside a transaction.
+                driver = (await conn.get_raw_connection()).driver_connection
+                await driver.add_listener(USER_CHANGES_CHANNEL, on_change)
+                telegram_user_cache.clear()
+                try:
+                    while True:
+                        await asyncio.sleep(interval)
+                        await driver.execute('SELECT 1')
+                finally:
+                    if not driver.is_closed():
+                        await driver.remove_listener(USER_CHANGES_CHANNEL, on_change)
+        except Exception:
+            logger.warning('Lost the %s listener; reconnecting', USER_CHANGES_CHANNEL, exc_info=True)
+            await asyncio.sleep(interval)
+
+
+def unlink_telegram_id(telegram_id: int, user_id: UUID):
+    """Statement that frees `telegram_id` from any other user before it is linked to `user_id`."""
+    return (
+        update(User)
+        .where(User.telegram_id == telegram_id, User.id != user_id)
+        .values(telegram_id=None)
+        .execution_options(synchronize_session=False)
+    )
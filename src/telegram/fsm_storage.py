@@ -0,0 +1,87 @@
+import os
+from typing import Any, Mapping
+
+from aiogram.exceptions import DataNotDictLikeError
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+from sqlalchemy import func, select
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.ext.asyncio import AsyncEngine, async_sessionmaker, create_async_engine
+
+from src.database.engine import get_sessionmaker
+from src.database.models import BotFSMState
+from dotenv import load_dotenv
+load_dotenv()
+
+# 'memory' keeps the FSM in the process (aiogram's MemoryStorage, also the
+# test double); 'sql' stores it in bot_fsm_states so every bot worker
+# process shares it. FSM_DATABASE_URL points the table at another database,
+# e.g. sqlite+aiosqlite:///bot_state.db; by default the app's database is used.
+FSM_STORAGE = os.getenv('FSM_STORAGE', 'memory')
+FSM_DATABASE_URL = os.getenv('FSM_DATABASE_URL')
+
+
+def storage_key(key: StorageKey) -> str:
+    parts = (key.bot_id, key.chat_id, key.user_id, key.thread_id, key.business_connection_id, key.destiny)
+    return ':'.join('' if part is None else str(part) for part in parts)
+
+
+class SQLStorage(BaseStorage):
+    """aiogram FSM storage on a SQL table; works on Postgres and SQLite."""
+
+    def __init__(self, url: str | None = None):
+        self._engine: AsyncEngine | None = create_async_engine(url) if url else None
+        self._sessionmaker = async_sessionmaker(self._engine, expire_on_commit=False) if url else None
+
+    @property
+    def Session(self) -> async_sessionmaker:
+        return self._sessionmaker or get_sessionmaker()
+
+    async def create_table(self):
+        async with self.Session() as session:
+            await session.run_sync(
+                lambda sync_session: BotFSMState.__table__.create(sync_session.connection(), checkfirst=True))
+            await session.commit()
+
+    async def _upsert(self, key: StorageKey, values: dict[str, Any]):
+        async with self.Session() as session:
+            dialect = sqlite if session.bind.dialect.name == 'sqlite' else postgresql
+            stmt = dialect.insert(BotFSMState).values({'key': storage_key(key), 'state': None, 'data': {}, **values})
+            stmt = stmt.on_conflict_do_update(index_elements=[BotFSMState.key],
+                                              set_={**values, 'updated_at': func.now()})
+            await session.execute(stmt)
+            await session.commit()
+
+    async def _get(self, column, key: StorageKey):
+        async with self.Session() as session:
+            return await session.scalar(select(column).where(BotFSMState.key == storage_key(key)))
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        await self._upsert(key, {'state': state.state if isinstance(state, State) else state})
+
+    async def get_state(self, key: StorageKey) -> str | None:
+        return await self._get(BotFSMState.state, key)
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        if not isinstance(data, dict):
+            raise DataNotDictLikeError(f"Data must be a dict or dict-like object, got {type(data).__name__}")
+        await self._upsert(key, {'data': data.copy()})
+
+    async def get_data(self, key: StorageKey) -> dict[str, Any]:
+        return dict(await self._get(BotFSMState.data, key) or {})
+
+    async def close(self) -> None:
+        if self._engine is not None:
+            await self._engine.dispose()
+
+
+async def get_fsm_storage() -> BaseStorage:
+    """The FSM storage selected by FSM_STORAGE: 'memory' (default) or 'sql'."""
+    if FSM_STORAGE == 'sql':
+        storage = SQLStorage(FSM_DATABASE_URL)
+        await storage.create_table()
+        return storage
+    if FSM_STORAGE != 'memory':
+        raise ValueError(f'Unknown FSM_STORAGE: {FSM_STORAGE!r}')
+    return MemoryStorage()
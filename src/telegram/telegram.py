@@ -1,40 +1,157 @@
+from collections import deque
 from contextlib import asynccontextmanager
+from typing import Any, Awaitable, Callable
+import logging
 import os
 
-from datetime import datetime
-
-from sqlalchemy import select, func
-from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
-from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from sqlalchemy import select
 
 from aiogram import Bot, Dispatcher, F
 from aiogram.types import Message
 from aiogram.filters import Command, CommandStart
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.context import FSMContext
+from aiogram.fsm.storage.memory import SimpleEventIsolation
 from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove
 from aiogram import Router
-
-from src.database.models import User, MetaLog
-from src.agentic_system.nodes_and_conditions import Graph
-from src.client.utils_httpx import login
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+from aiogram.utils.chat_action import ChatActionSender
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
+
+from src.database.engine import get_sessionmaker, dispose_engine
+from src.database.usage import token_usage_writer, get_monthly_tokens
+from src.database.models import User
+from src.database.user_cache import (get_telegram_user, invalidate_telegram_user,
+                                     listen_telegram_user_changes, unlink_telegram_id)
+from src.agentic_system.nodes_and_conditions import get_workflow
+from src.telegram.fsm_storage import get_fsm_storage
+from src.client.utils_httpx import login, aclose_client
 import asyncio
+import time
 from dotenv import load_dotenv
 load_dotenv()
 BOT_TOKEN = os.getenv("WISECOLLECT_BOT_TOKEN")
 BACKEND_URL = os.getenv("BACKEND_URL")
 FRONTEND_URL = os.getenv("FRONTEND_URL")
-DATABASE_URL = os.getenv('DATABASE_URL')
-
-workflow = Graph()
 
-engine = create_async_engine(DATABASE_URL)
-Session = async_sessionmaker(engine, expire_on_commit=False)
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.0"))
+TELEGRAM_MAX_LENGTH = 4096
+
+# 'polling' (default, local development) or 'webhook'.
+BOT_MODE = os.getenv("BOT_MODE", "polling").lower()
+WEBHOOK_BASE_URL = os.getenv("WEBHOOK_BASE_URL")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8081"))
+# GET /metrics is served on its own, internal address, never on the public
+# webhook port. METRICS_PORT=0 turns it off.
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9100"))
+
+USER_QUEUE_MAX_WORKERS = int(os.getenv("USER_QUEUE_MAX_WORKERS", "8"))
+USER_QUEUE_MAX_DEPTH = int(os.getenv("USER_QUEUE_MAX_DEPTH", "5"))
+USER_QUEUE_MAX_PENDING = int(os.getenv("USER_QUEUE_MAX_PENDING", "500"))
+USER_QUEUE_METRICS_INTERVAL = float(os.getenv("USER_QUEUE_METRICS_INTERVAL", "60"))
+
+logger = logging.getLogger(__name__)
+
+
+class UserQueues:
+    """Runs each user's jobs one at a time, in arrival order, and different
+    users in parallel up to `max_workers` jobs at once.
+
+    submit() refuses a job (returns False) when the user already has
+    `max_depth` jobs waiting or `max_pending` jobs are waiting overall.
+    """
+
+    def __init__(self, max_workers: int = USER_QUEUE_MAX_WORKERS,
+                 max_depth: int = USER_QUEUE_MAX_DEPTH,
+                 max_pending: int = USER_QUEUE_MAX_PENDING):
+        self.max_depth = max_depth
+        self.max_pending = max_pending
+        self._workers = asyncio.Semaphore(max_workers)
+        self._queues: dict[int, deque] = {}
+        self._drainers: dict[int, asyncio.Task] = {}
+        self.pending = 0
+        self.running = 0
+        self.processed = 0
+        self.rejected = 0
+        self.failed = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def submit(self, user_key: int, job: Callable[[], Awaitable[Any]]) -> bool:
+        if self.depth(user_key) >= self.max_depth or self.pending >= self.max_pending:
+            self.rejected += 1
+            return False
+        # Only accepted jobs create a queue; _drain removes it once empty.
+        self._queues.setdefault(user_key, deque()).append((time.monotonic(), job))
+        self.pending += 1
+        if user_key not in self._drainers:
+            self._drainers[user_key] = asyncio.create_task(self._drain(user_key))
+        return True
+
+    async def _drain(self, user_key: int):
+        queue = self._queues[user_key]
+        try:
+            while queue:
+                enqueued_at, job = queue[0]
+                async with self._workers:
+                    queue.popleft()
+                    self.pending -= 1
+                    waited = time.monotonic() - enqueued_at
+                    self.wait_total += waited
+                    self.wait_max = max(self.wait_max, waited)
+                    self.running += 1
+                    try:
+                        await job()
+                    except Exception:
+                        self.failed += 1
+                        logger.exception('Job for user %s failed', user_key)
+                    finally:
+                        self.running -= 1
+                        self.processed += 1
+        finally:
+            del self._queues[user_key]
+            del self._drainers[user_key]
+
+    def depth(self, user_key: int) -> int:
+        return len(self._queues.get(user_key, ()))
+
+    def metrics(self) -> dict:
+        started = self.processed + self.running
+        return {
+            'queue_pending': self.pending,
+            'queue_users': len(self._queues),
+            'queue_max_user_depth': max((len(q) for q in self._queues.values()), default=0),
+            'jobs_running': self.running,
+            'jobs_processed': self.processed,
+            'jobs_failed': self.failed,
+            'jobs_rejected': self.rejected,
+            'wait_seconds_avg': self.wait_total / started if started else 0.0,
+            'wait_seconds_max': self.wait_max,
+        }
+
+    async def join(self):
+        """Wait until every accepted job has run."""
+        while self._drainers:
+            await asyncio.gather(*self._drainers.values(), return_exceptions=True)
+
+
+user_queues = UserQueues()
+
+
+async def log_queue_metrics(interval: float = USER_QUEUE_METRICS_INTERVAL):
+    while True:
+        await asyncio.sleep(interval)
+        logger.info('user queues: %s', user_queues.metrics())
 
 
 @asynccontextmanager
 async def get_session():
-    session = Session()
+    session = get_sessionmaker()()
     try:
         yield session
         await session.commit()
@@ -44,6 +161,94 @@ async def get_session():
     finally:
         await session.close()
 
+async def safe_edit(reply: Message, text: str) -> bool:
+    try:
+        await reply.edit_text(text[:TELEGRAM_MAX_LENGTH])
+        return True
+    except TelegramRetryAfter:
+        return False
+    except TelegramBadRequest as e:
+        # Editing to the same text is rejected by Telegram; nothing to do.
+        if 'message is not modified' in str(e):
+            return True
+        raise
+
+
+def split_message(text: str, limit: int = TELEGRAM_MAX_LENGTH) -> list[str]:
+    """Split `text` into parts Telegram accepts, at a line break or space near the limit when there is one."""
+    parts = []
+    while len(text) > limit:
+        cut = text.rfind('\n', limit // 2, limit)
+        if cut == -1:
+            cut = text.rfind(' ', limit // 2, limit)
+        if cut == -1:
+            parts.append(text[:limit])
+            text = text[limit:]
+        else:
+            parts.append(text[:cut])
+            text = text[cut + 1:]
+    parts.append(text)
+    return parts
+
+
+async def stream_answer(message: Message, chunks) -> Message | None:
+    """Send the first chunk as a reply and edit it as the text grows.
+
+    Edits are throttled to one per STREAM_EDIT_INTERVAL seconds to stay
+    under Telegram's rate limits; the latest text is always flushed at the
+    end. Text past TELEGRAM_MAX_LENGTH goes out in follow-up messages once
+    the answer is complete. Returns the reply, or None if nothing was
+    produced.
+    """
+    reply, sent, last_edit = None, '', 0.0
+    text = ''
+    async for text in chunks:
+        now = time.monotonic()
+        head = text[:TELEGRAM_MAX_LENGTH]
+        if reply is None:
+            reply = await message.answer(head)
+            sent, last_edit = head, now
+        elif head != sent and now - last_edit >= STREAM_EDIT_INTERVAL:
+            if await safe_edit(reply, head):
+                sent = head
+            last_edit = now
+    if reply is not None:
+        first, *rest = split_message(text)
+        if first != sent:
+            await flush_edit(message, reply, first)
+        for part in rest:
+            await answer_part(message, part)
+    return reply
+
+
+async def answer_part(message: Message, text: str) -> Message:
+    """Send a follow-up part of an answer, waiting out one rate limit."""
+    try:
+        return await message.answer(text)
+    except TelegramRetryAfter as e:
+        await asyncio.sleep(e.retry_after)
+    return await message.answer(text)
+
+
+async def flush_edit(message: Message, reply: Message, text: str) -> Message:
+    """Final edit of a streamed reply; unlike the throttled ones it must land.
+
+    On a rate limit it waits the time Telegram asks for and retries once; if
+    that is refused too, the full text goes out as a new message.
+    """
+    try:
+        await reply.edit_text(text[:TELEGRAM_MAX_LENGTH])
+        return reply
+    except TelegramRetryAfter as e:
+        await asyncio.sleep(e.retry_after)
+    except TelegramBadRequest as e:
+        if 'message is not modified' in str(e):
+            return reply
+        raise
+    if await safe_edit(reply, text):
+        return reply
+    return await message.answer(text[:TELEGRAM_MAX_LENGTH])
+
 router = Router(name = __name__)
 class LoginStates(StatesGroup):
     is_registered = State()
@@ -61,6 +266,7 @@ async def start(message: Message, state: FSMContext):
     async with get_session() as session:
         user = await session.scalar(select(User).where(User.id == user_id))
         if user:
+            await session.execute(unlink_telegram_id(telegram_user_id, user.id))
             user.telegram_id = telegram_user_id
             is_act = user.is_active
             await session.commit()
@@ -74,6 +280,7 @@ async def start(message: Message, state: FSMContext):
                 user = await session.scalar(select(User).where(User.id == user_id))
                 user.is_active = True
                 await session.commit()
+        invalidate_telegram_user(telegram_user_id)
 
     else:
         await message.answer(
@@ -129,8 +336,10 @@ async def process_password(message: Message, state: FSMContext):
     if token_data:
         async with get_session() as session:
             user = await session.scalar(select(User).where(User.email == email))
+            await session.execute(unlink_telegram_id(telegram_user_id, user.id))
             user.telegram_id = telegram_user_id
             await session.commit()
+        invalidate_telegram_user(telegram_user_id)
         fullname = f"{token_data['user']['first_name']} {token_data['user']['last_name']}"
         await message.answer(f"Bem-vindo {fullname}!")
     else:
@@ -151,42 +360,29 @@ async def process_login(message: Message):
         disable_web_page_preview=True
     )
 
-@router.message()
-async def respond(message: Message, state: FSMContext):
-    now = datetime.now()
-    current_month = now.month
-    current_year = now.year
-
+async def answer_message(message: Message, state: FSMContext):
     telegram_user_id = int(message.from_user.id)
     user_message = message.text
 
-    async with get_session() as session:
-        db_user = await session.scalar(
-            select(User).where(User.telegram_id == telegram_user_id)
-        )
-        stmt = select(func.sum(MetaLog.n_tokens)).where(
-    MetaLog.user_id == db_user.id,
-    func.extract("month", MetaLog.created_at) == current_month,
-    func.extract("year", MetaLog.created_at) == current_year
-)
-        total_tokens = await session.scalar(stmt)
-
-    if total_tokens:
+    db_user = await get_telegram_user(telegram_user_id)
+
+    if db_user:
+        total_tokens = await get_monthly_tokens(db_user.id)
         if total_tokens > 100000:
             await message.answer(f'Numero total de tokens deste mês foi atingido: {total_tokens}.')
             return None
-
-    if db_user:
         user_id = db_user.id
-        thread = {'configurable': {'thread_id': user_id, 'user_id': user_id}}
-        await workflow.async_invoking(message=user_message, config=thread)
-        state = await workflow.async_state(config=thread)
-        response_text = ''
-        for i in reversed(state.values['messages']):
-            if i.role == 'user':
-                break
-            response_text += i.content
-        await message.answer(response_text)
+        thread = {'configurable': {'thread_id': user_id, 'user_id': user_id, 'user_name': db_user.name}}
+        async with ChatActionSender.typing(bot=message.bot, chat_id=message.chat.id):
+            reply = await stream_answer(message, get_workflow().async_streaming(message=user_message, config=thread))
+        if reply is None:
+            state = await get_workflow().async_state(config=thread)
+            response_text = ''
+            for i in reversed(state.values['messages']):
+                if i.role == 'user':
+                    break
+                response_text += i.content
+            await message.answer(response_text)
     else:
         await message.answer(
                 "Seu número de telegram não está cadastrado. Você já é registrado no nosso serviço? (sim/não)",
@@ -198,13 +394,104 @@ async def respond(message: Message, state: FSMContext):
         await state.set_state(LoginStates.is_registered)
 
 
+@router.message()
+async def respond(message: Message, state: FSMContext):
+    # Messages of one user run in order, so two runs never share the
+    # conversation state or the inventory rows at the same time.
+    telegram_user_id = int(message.from_user.id)
+    if not user_queues.submit(telegram_user_id, lambda: answer_message(message, state)):
+        if user_queues.depth(telegram_user_id) >= user_queues.max_depth:
+            await message.answer("Ainda estou processando suas mensagens anteriores. Aguarde um momento e tente novamente.")
+        else:
+            await message.answer("Estou com muitas mensagens no momento. Tente novamente em alguns instantes.")
+
+async def metrics_view(request: web.Request) -> web.Response:
+    return web.json_response(user_queues.metrics())
+
+
+def build_webhook_app(bot: Bot, dp: Dispatcher) -> web.Application:
+    """aiohttp app serving Telegram updates on WEBHOOK_PATH.
+
+    Requests without the X-Telegram-Bot-Api-Secret-Token header matching
+    WEBHOOK_SECRET are rejected. Updates are acknowledged right away and
+    handled in background tasks.
+    """
+    app = web.Application()
+    SimpleRequestHandler(dispatcher=dp, bot=bot, handle_in_background=True,
+                         secret_token=WEBHOOK_SECRET).register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+    return app
+
+
+async def start_metrics_server(view) -> web.AppRunner | None:
+    """Serve `view` as GET /metrics on METRICS_HOST:METRICS_PORT; returns the runner to clean up."""
+    if not METRICS_PORT:
+        return None
+    app = web.Application()
+    app.router.add_get('/metrics', view)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host=METRICS_HOST, port=METRICS_PORT).start()
+    return runner
+
+
+async def run_webhook(bot: Bot, app: web.Application, allowed_updates: list[str]):
+    """Serve `app` on WEBHOOK_HOST:WEBHOOK_PORT and point Telegram's webhook at it."""
+    if not WEBHOOK_SECRET or not WEBHOOK_BASE_URL:
+        raise RuntimeError("BOT_MODE=webhook requires WEBHOOK_BASE_URL and WEBHOOK_SECRET.")
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host=WEBHOOK_HOST, port=WEBHOOK_PORT).start()
+    await bot.set_webhook(f"{WEBHOOK_BASE_URL.rstrip('/')}{WEBHOOK_PATH}",
+                          secret_token=WEBHOOK_SECRET,
+                          allowed_updates=allowed_updates)
+    print(f"WEBHOOK LISTENING ON {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+
+async def build_dispatcher() -> Dispatcher:
+    # The isolation lock makes a user's updates go through the FSM one at a
+    # time, in arrival order, even when the storage has to await a database.
+    dp = Dispatcher(storage=await get_fsm_storage(), events_isolation=SimpleEventIsolation())
+    dp.include_router(router)
+    # Compile the graph before taking updates, not on the first message.
+    get_workflow()
+    return dp
+
+
+async def close_bot(bot: Bot, dp: Dispatcher):
+    await user_queues.join()
+    await bot.session.close()
+    await dp.storage.close()
+    await token_usage_writer.aclose()
+    await aclose_client()
+    await dispose_engine()
+
+
 async def main():
     bot = Bot(token=BOT_TOKEN)
-    dp = Dispatcher()
-    dp.include_router(router)
+    dp = await build_dispatcher()
 
     print("BOT RUNNING")
-    await dp.start_polling(bot)
+    metrics_task = asyncio.create_task(log_queue_metrics())
+    user_changes_task = asyncio.create_task(listen_telegram_user_changes())
+    metrics_runner = await start_metrics_server(metrics_view)
+    try:
+        if BOT_MODE == "webhook":
+            await run_webhook(bot, build_webhook_app(bot, dp), dp.resolve_used_update_types())
+        else:
+            await bot.delete_webhook()
+            await dp.start_polling(bot)
+    finally:
+        metrics_task.cancel()
+        user_changes_task.cancel()
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        await close_bot(bot, dp)
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(main())
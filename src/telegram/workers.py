@@ -0,0 +1,212 @@
+"""Multi-process bot.
+
+A supervisor receives the updates from Telegram (polling or webhook, as
+BOT_MODE) and hands each one to one of BOT_WORKERS worker processes, chosen
+by hashing the user id. A user always lands on the same worker, which feeds
+their updates to the dispatcher in arrival order; different users are
+spread over the cores.
+
+Every worker runs the single-process bot's dispatcher, with its own user
+queues and database pool (so USER_QUEUE_MAX_WORKERS and DB_POOL_SIZE are
+per worker). Run with FSM_STORAGE=sql and CHECKPOINT_BACKEND=postgres so
+the login flow and the conversations outlive a worker and a change of
+BOT_WORKERS.
+"""
+import asyncio
+import logging
+import multiprocessing
+import os
+import secrets
+import signal
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramNetworkError, TelegramRetryAfter, TelegramServerError
+from aiogram.types import Update
+from aiogram.types.update import UpdateTypeLookupError
+from aiohttp import web
+
+from src.database.user_cache import listen_telegram_user_changes
+from src.telegram.fsm_storage import FSM_STORAGE
+from src.telegram.telegram import (BOT_MODE, BOT_TOKEN, WEBHOOK_PATH, WEBHOOK_SECRET,
+                                   build_dispatcher, close_bot, log_queue_metrics,
+                                   router, run_webhook, start_metrics_server)
+from dotenv import load_dotenv
+load_dotenv()
+
+BOT_WORKERS = int(os.getenv("BOT_WORKERS", str(os.cpu_count() or 1)))
+WORKER_CHECK_INTERVAL = float(os.getenv("WORKER_CHECK_INTERVAL", "5"))
+POLLING_TIMEOUT = 30
+
+logger = logging.getLogger(__name__)
+
+
+def shard_of(update: Update, workers: int) -> int:
+    """Index of the worker for `update`: by user, else by chat, else by update."""
+    try:
+        event = update.event
+    except UpdateTypeLookupError:
+        return update.update_id % workers
+    user = getattr(event, 'from_user', None)
+    chat = getattr(event, 'chat', None)
+    # hash() of an int does not depend on the process, unlike that of a str.
+    key = user.id if user else chat.id if chat else update.update_id
+    return hash(key) % workers
+
+
+async def _feed(dp, bot: Bot, update: Update):
+    try:
+        await dp.feed_update(bot, update)
+    except Exception:
+        logger.exception('Update %s failed', update.update_id)
+
+
+async def run_worker(updates: multiprocessing.Queue):
+    """Handle the JSON updates from `updates` until the supervisor sends None."""
+    bot = Bot(token=BOT_TOKEN)
+    dp = await build_dispatcher()
+    loop = asyncio.get_running_loop()
+    metrics_task = asyncio.create_task(log_queue_metrics())
+    user_changes_task = asyncio.create_task(listen_telegram_user_changes())
+    handling: set[asyncio.Task] = set()
+    try:
+        while (data := await loop.run_in_executor(None, updates.get)) is not None:
+            update = Update.model_validate_json(data, context={'bot': bot})
+            task = asyncio.create_task(_feed(dp, bot, update))
+            handling.add(task)
+            task.add_done_callback(handling.discard)
+        await asyncio.gather(*handling)
+    finally:
+        metrics_task.cancel()
+        user_changes_task.cancel()
+        await close_bot(bot, dp)
+
+
+def worker_process(index: int, updates: multiprocessing.Queue):
+    # Ctrl+C reaches the whole process group; workers stop when the
+    # supervisor tells them to, after the updates already routed to them.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    logging.basicConfig(level=logging.INFO, format=f'worker-{index} %(levelname)s %(name)s: %(message)s')
+    asyncio.run(run_worker(updates))
+
+
+class Supervisor:
+    """Starts the worker processes, routes updates to them and restarts the
+    ones that die.
+
+    Each worker reads from its own queue. A replacement gets a new queue:
+    a worker killed while reading may hold the old queue's lock forever, so
+    the updates still waiting in it are dropped.
+    """
+
+    def __init__(self, workers: int = BOT_WORKERS):
+        self.context = multiprocessing.get_context('spawn')
+        self.queues = [self.context.Queue() for _ in range(workers)]
+        self.processes: list[multiprocessing.Process] = []
+        self.routed = [0] * workers
+        self.restarts = 0
+
+    def _spawn(self, index: int) -> multiprocessing.Process:
+        process = self.context.Process(target=worker_process, args=(index, self.queues[index]),
+                                       name=f'bot-worker-{index}')
+        process.start()
+        return process
+
+    def start(self):
+        self.processes = [self._spawn(index) for index in range(len(self.queues))]
+
+    def route(self, update: Update, data: str):
+        index = shard_of(update, len(self.queues))
+        self.queues[index].put(data)
+        self.routed[index] += 1
+
+    def metrics(self) -> dict:
+        return {
+            'workers': len(self.processes),
+            'workers_alive': sum(process.is_alive() for process in self.processes),
+            'worker_restarts': self.restarts,
+            'updates_routed': self.routed,
+            'updates_queued': [queue.qsize() for queue in self.queues],
+        }
+
+    async def watch(self, interval: float = WORKER_CHECK_INTERVAL):
+        while True:
+            await asyncio.sleep(interval)
+            for index, process in enumerate(self.processes):
+                if not process.is_alive():
+                    logger.error('Worker %s exited with code %s; restarting it, %s queued updates dropped',
+                                 index, process.exitcode, self.queues[index].qsize())
+                    self.restarts += 1
+                    self.queues[index] = self.context.Queue()
+                    self.processes[index] = self._spawn(index)
+
+    async def stop(self):
+        for queue in self.queues:
+            queue.put(None)
+        loop = asyncio.get_running_loop()
+        for process in self.processes:
+            await loop.run_in_executor(None, process.join)
+
+    async def poll(self, bot: Bot):
+        await bot.delete_webhook()
+        allowed_updates = router.resolve_used_update_types()
+        offset = None
+        while True:
+            try:
+                updates = await bot.get_updates(offset=offset, timeout=POLLING_TIMEOUT,
+                                                allowed_updates=allowed_updates)
+            except TelegramRetryAfter as e:
+                await asyncio.sleep(e.retry_after)
+                continue
+            except (TelegramNetworkError, TelegramServerError):
+                logger.warning('getUpdates failed; retrying', exc_info=True)
+                await asyncio.sleep(1)
+                continue
+            for update in updates:
+                self.route(update, update.model_dump_json(by_alias=True, exclude_unset=True))
+                offset = update.update_id + 1
+
+    async def webhook_view(self, request: web.Request) -> web.Response:
+        token = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+        if not secrets.compare_digest(token, WEBHOOK_SECRET or ''):
+            return web.Response(status=401)
+        data = await request.text()
+        self.route(Update.model_validate_json(data), data)
+        return web.Response()
+
+    async def metrics_view(self, request: web.Request) -> web.Response:
+        return web.json_response(self.metrics())
+
+    def webhook_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post(WEBHOOK_PATH, self.webhook_view)
+        return app
+
+
+async def run_supervisor(workers: int = BOT_WORKERS):
+    from src.agentic_system.checkpointer import CHECKPOINT_BACKEND
+    if FSM_STORAGE == 'memory' or CHECKPOINT_BACKEND == 'memory':
+        logger.warning('FSM_STORAGE=%s and CHECKPOINT_BACKEND=%s: state kept in memory is lost when a '
+                       'worker restarts or BOT_WORKERS changes.', FSM_STORAGE, CHECKPOINT_BACKEND)
+    supervisor = Supervisor(workers)
+    supervisor.start()
+    bot = Bot(token=BOT_TOKEN)
+    watch_task = asyncio.create_task(supervisor.watch())
+    metrics_runner = await start_metrics_server(supervisor.metrics_view)
+
+    print(f"SUPERVISOR RUNNING WITH {workers} WORKERS")
+    try:
+        if BOT_MODE == "webhook":
+            await run_webhook(bot, supervisor.webhook_app(), router.resolve_used_update_types())
+        else:
+            await supervisor.poll(bot)
+    finally:
+        watch_task.cancel()
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        await bot.session.close()
+        await supervisor.stop()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(run_supervisor())
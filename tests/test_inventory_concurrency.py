@@ -0,0 +1,59 @@
+import asyncio
+import os
+import unittest
+from uuid import uuid4
+
+from sqlalchemy import delete, select
+
+from src.agentic_system.utils_async import DatabaseHandler
+from src.database.engine import dispose_engine, get_sessionmaker
+from src.database.models import InventoryItem, User
+from dotenv import load_dotenv
+load_dotenv()
+
+
+@unittest.skipUnless(os.getenv('DATABASE_URL', '').startswith('postgresql'),
+                     'needs DATABASE_URL pointing at a Postgres database with the tables built')
+class ConcurrentSubtractTest(unittest.IsolatedAsyncioTestCase):
+    """N concurrent subtracts on one item: none is lost and none overdraws it."""
+
+    STOCK = 10
+    CALLS = 15
+
+    async def asyncSetUp(self):
+        tag = uuid4().hex[:12]
+        async with get_sessionmaker()() as session:
+            user = User(first_name=f'test-{tag}', last_name=f'test-{tag}', email=f'{tag}@test.local',
+                        telegram_id=None, is_active=True, hashed_password='x')
+            session.add(user)
+            await session.flush()
+            session.add(InventoryItem(user_id=user.id, name='Arroz', quantity=self.STOCK, unit='kg',
+                                      description=None, category=None, location=None))
+            await session.commit()
+            self.user_id = user.id
+
+    async def asyncTearDown(self):
+        async with get_sessionmaker()() as session:
+            await session.execute(delete(InventoryItem).where(InventoryItem.user_id == self.user_id))
+            await session.execute(delete(User).where(User.id == self.user_id))
+            await session.commit()
+        await dispose_engine()
+
+    async def test_no_lost_updates(self):
+        handler = DatabaseHandler()
+        messages = await asyncio.gather(*(
+            handler.subtract_to_existing_item(self.user_id, 'arroz', 1) for _ in range(self.CALLS)
+        ))
+
+        applied = [m for m in messages if m.startswith('Subtraido')]
+        rejected = [m for m in messages if 'é maior que a quantidade' in m]
+        self.assertEqual(len(applied), self.STOCK)
+        self.assertEqual(len(rejected), self.CALLS - self.STOCK)
+        async with get_sessionmaker()() as session:
+            quantity = await session.scalar(
+                select(InventoryItem.quantity).where(InventoryItem.user_id == self.user_id))
+        self.assertEqual(quantity, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()